@@ -0,0 +1,329 @@
+import os
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Optional
+from dotenv import load_dotenv
+import httpx
+import http_client
+import cache
+import checkpoints
+import metrics
+from db import SessionLocal, Company
+from parser import (
+    API_KEY, GEOCODE_API_URL, LARGE_RADIUS_METERS, DETAIL_FIELDS,
+    RunStats, _search_request, _details_request, _geocode_params, _geocode_location,
+    _new_places, _company_rows, _mark_stored, _location_steps,
+    _collect_options, _manual_units, _location_units, _plan_units, find_city, normalize_city_name,
+    save_companies, log_status,
+)
+
+# Collector on asyncio: the same search page -> details -> save pipeline as
+# parser.collect_companies, but every unit and details fetch is a coroutine
+# on one event loop, so in-flight calls are bounded by semaphores instead of
+# by city and details threads. Database and cache work still runs in worker
+# threads, since the SQLAlchemy setup is synchronous; they come from a pool of
+# the collector's own, so a busy job does not take the threads the bot's
+# handlers get from the loop's default executor.
+
+# Configuration
+load_dotenv()
+# Units (keyword and city pairs) of one job collected at the same time
+ASYNC_UNIT_CONCURRENCY = int(os.getenv("ASYNC_UNIT_CONCURRENCY", "32"))
+# Threads for the database and cache calls of all async jobs of the process
+ASYNC_DB_WORKERS = int(os.getenv("ASYNC_DB_WORKERS", "8"))
+
+_db_executor: Optional[ThreadPoolExecutor] = None
+_db_executor_lock = threading.Lock()
+
+def _get_db_executor() -> ThreadPoolExecutor:
+    global _db_executor
+    with _db_executor_lock:
+        if _db_executor is None:
+            _db_executor = ThreadPoolExecutor(max_workers=ASYNC_DB_WORKERS, thread_name_prefix="async-db")
+        return _db_executor
+
+async def _in_thread(func, *args, **kwargs):
+    """Run a blocking call on the collector's own thread pool."""
+    return await asyncio.get_running_loop().run_in_executor(_get_db_executor(), partial(func, *args, **kwargs))
+
+async def search_places_async(api_key, keyword, latitude, longitude, page_token=None, rad: int=LARGE_RADIUS_METERS, single_call: bool=False, stats: Optional[RunStats]=None, force_refresh: bool=False, rectangle: bool=False, cache_writes: Optional[list]=None):
+    """parser.search_places on the shared async client."""
+    cache_key, url, headers, data = _search_request(api_key, keyword, latitude, longitude, page_token, rad, single_call, rectangle)
+    if not force_refresh and cache.CACHE_ENABLED:
+        cached = await _in_thread(cache.get, "searchText", cache_key, stats)
+        if cached is not None:
+            return cached
+    metrics.incr("searchText", stats=stats)
+    try:
+        response = await http_client.post_async(url, headers=headers, json=data, stats=stats, limiter=http_client.places_limiter, metric="searchText")
+    except httpx.HTTPError as e:
+        return f"Error: {e!r}"
+    if response.status_code == 200:
+        result = response.json()
+        if cache_writes is not None:
+            cache.put("searchText", cache_key, result, cache_writes)
+        elif cache.CACHE_ENABLED:
+            await _in_thread(cache.put, "searchText", cache_key, result)
+        return result
+    return f"Error: {response.status_code} - {response.text}"
+
+async def get_place_details_async(api_key, place_id, stats: Optional[RunStats]=None, force_refresh: bool=False, cache_writes: Optional[list]=None):
+    """parser.get_place_details on the shared async client."""
+    cache_key, url, headers = _details_request(api_key, place_id)
+    if not force_refresh and cache.CACHE_ENABLED:
+        cached = await _in_thread(cache.get, "details", cache_key, stats)
+        if cached is not None:
+            return cached
+    metrics.incr("details", stats=stats)
+    try:
+        response = await http_client.get_async(url, headers=headers, stats=stats, limiter=http_client.places_limiter, metric="details")
+    except httpx.HTTPError as e:
+        return f"Error: {e!r}"
+    if response.status_code == 200:
+        result = response.json()
+        if cache_writes is not None:
+            cache.put("details", cache_key, result, cache_writes)
+        elif cache.CACHE_ENABLED:
+            await _in_thread(cache.put, "details", cache_key, result)
+        return result
+    return f"Error: {response.status_code} - {response.text}"
+
+async def geocode_city_async(city_name, state_code, stats: Optional[RunStats]=None) -> tuple[float, float]:
+    """parser.geocode_city on the shared async client."""
+    metrics.incr("geocode", stats=stats)
+    try:
+        resp = await http_client.get_async(GEOCODE_API_URL, params=_geocode_params(city_name, state_code), stats=stats, limiter=http_client.geocode_limiter, metric="geocode")
+    except httpx.HTTPError as e:
+        raise RuntimeError(f"Failed to geocode city '{city_name}': {e!r}")
+    return _geocode_location(resp, city_name, state_code)
+
+async def resolve_city_async(city_name: str, state_code: str, stats: Optional[RunStats]=None) -> tuple[float, float]:
+    """parser.resolve_city: states.json first, then the geocode cache, then the API."""
+    found = find_city(city_name, state_code)
+    if found:
+        _, city_data = found
+        return city_data["lat"], city_data["lng"]
+    cache_key = cache.make_key("geocode", city=normalize_city_name(city_name), state=state_code)
+    cached = await _in_thread(cache.get, "geocode", cache_key, stats)
+    if cached is not None:
+        return cached["lat"], cached["lng"]
+    lat, lng = await geocode_city_async(city_name, state_code, stats=stats)
+    await _in_thread(cache.put, "geocode", cache_key, {"lat": lat, "lng": lng})
+    return lat, lng
+
+async def _fetch_details(place: dict, stats: Optional[RunStats], force_refresh: bool, cache_writes: Optional[list]=None):
+    # Search results that already carry every detail field need no extra call
+    if all(field in place for field in DETAIL_FIELDS):
+        return place
+    return await get_place_details_async(API_KEY, place["id"], stats=stats, force_refresh=force_refresh, cache_writes=cache_writes)
+
+async def fetch_details_for_page(places: list[dict], stats: Optional[RunStats]=None, force_refresh: bool=False, inflight: Optional[dict]=None, cache_writes: Optional[list]=None) -> list:
+    """Fetch details for a page of places concurrently, results in page order.
+
+    inflight maps place_id to the task fetching it, see parser.fetch_details_for_page.
+    """
+    if inflight is None:
+        return await asyncio.gather(*(_fetch_details(place, stats, force_refresh, cache_writes) for place in places))
+    fetches = []
+    for place in places:
+        fetch = inflight.get(place["id"])
+        if fetch is None:
+            fetch = inflight[place["id"]] = asyncio.ensure_future(_fetch_details(place, stats, force_refresh, cache_writes))
+        fetches.append(fetch)
+    return await asyncio.gather(*fetches)
+
+def _existing_place_ids(place_ids: set[str]) -> set[str]:
+    with SessionLocal() as db:
+        return {row[0] for row in db.query(Company.place_id).filter(Company.place_id.in_(place_ids))}
+
+def _save(rows: list[dict], job_run_id, linked, stats, unit_key, cache_writes) -> bool:
+    with SessionLocal() as db:
+        return save_companies(db, rows, job_run_id, linked, stats, unit_key, cache_writes)
+
+async def _store_places(
+    places: list[dict],
+    keyword: str,
+    state: Optional[str],
+    job_run_id: Optional[int],
+    single_call: bool,
+    stats: Optional[RunStats],
+    force_refresh: bool,
+    seen: set[str],
+    city: Optional[str]=None,
+    city_type: Optional[str]=None,
+    unit_key: Optional[str]=None,
+    details_inflight: Optional[dict]=None,
+    cache_writes: Optional[list]=None,
+):
+    """parser._store_places with the lookup and save in a worker thread."""
+    try:
+        candidates = {place["id"] for place in places} - seen
+        if not candidates:
+            return
+        existing = await _in_thread(_existing_place_ids, candidates)
+        new_places = _new_places(places, seen, existing, single_call)
+        details_results = await fetch_details_for_page(new_places, stats, force_refresh, details_inflight, cache_writes)
+        rows = _company_rows(new_places, details_results, keyword, state, city, city_type, details_inflight)
+        linked = existing if job_run_id else set()
+        if (rows or linked) and await _in_thread(_save, rows, job_run_id, linked, stats, unit_key, cache_writes):
+            _mark_stored(rows, linked, seen, details_inflight)
+    finally:
+        if cache_writes:
+            await _in_thread(cache.flush, cache_writes)
+
+async def _collect_one_location(
+    keyword: str,
+    lat: float,
+    lng: float,
+    state: Optional[str],
+    job_run_id: Optional[int],
+    city_type: Optional[str],
+    mode: str,
+    stats: RunStats,
+    force_refresh: bool,
+    adaptive_grid: bool,
+    tile_memo: dict,
+    city: Optional[str],
+    checkpoint_key: Optional[str],
+    details_inflight: dict,
+):
+    """parser._collect_one_location, performing the steps of parser._location_steps with awaits."""
+    single_call = mode == "single"
+    city = normalize_city_name(city) if city else None
+    seen: set[str] = set()
+    checkpointed = job_run_id is not None and checkpoint_key is not None
+    resumed = await _in_thread(checkpoints.load, job_run_id, checkpoint_key) if checkpointed else None
+    steps = _location_steps(keyword, lat, lng, city_type, single_call, force_refresh, adaptive_grid, tile_memo, checkpointed, resumed, stats)
+    # Responses of the current page, cached in one write when the page is stored
+    cache_writes: list[dict] = []
+    result = None
+    while True:
+        try:
+            step = steps.send(result)
+        except StopIteration:
+            break
+        result = None
+        if step[0] == "search":
+            result = await search_places_async(API_KEY, keyword, *step[1], single_call=single_call, stats=stats, cache_writes=cache_writes, **step[2])
+        elif step[0] == "store":
+            await _store_places(step[1], keyword, state, job_run_id, single_call, stats, force_refresh, seen, city, city_type, checkpoint_key, details_inflight, cache_writes)
+        else:
+            await _in_thread(checkpoints.save, job_run_id, checkpoint_key, *step[1:])
+
+    if checkpointed:
+        await _in_thread(checkpoints.mark_done, job_run_id, checkpoint_key)
+
+async def _wait_for(source_job_run_id: int, key: str, timeout: float = checkpoints.PLANNER_WAIT_SECONDS) -> bool:
+    """checkpoints.wait_for without holding a thread while waiting."""
+    deadline = time.monotonic() + timeout
+    while True:
+        finished = await _in_thread(checkpoints.unit_finished, source_job_run_id, key)
+        if finished is not None:
+            return finished
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(checkpoints.PLANNER_POLL_SECONDS)
+
+async def _collect_unit(unit: tuple, task_id: Optional[str], job_run_id: Optional[int], limit: asyncio.Semaphore, options: dict) -> bool:
+    """Collect one unit once a slot is free; errors are logged, not raised."""
+    keyword, state_code, current_type, city_data, key = unit
+    async with limit:
+        await _in_thread(log_status, task_id, f"Collecting '{keyword}' for {city_data['city']}, {state_code} ({current_type or 'manual'})")
+        try:
+            await _collect_one_location(
+                keyword,
+                city_data['lat'],
+                city_data['lng'],
+                state_code,
+                job_run_id,
+                city_type=current_type,
+                city=city_data['city'],
+                checkpoint_key=key,
+                **options,
+            )
+            return True
+        except Exception as e:
+            await _in_thread(log_status, task_id, f"Error collecting for {city_data['city']}, {state_code}: {str(e)}")
+            return False
+
+async def _collect_units(units: list, task_id: Optional[str], job_run_id: Optional[int], concurrency: int, options: dict):
+    limit = asyncio.Semaphore(max(1, concurrency))
+    results = await asyncio.gather(*(_collect_unit(unit, task_id, job_run_id, limit, options) for unit in units))
+    failed = results.count(False)
+    if failed:
+        await _in_thread(log_status, task_id, f"{failed} of {len(units)} cities failed, see errors above")
+
+async def collect_companies_async(
+    keyword: str | list[str],
+    states: Optional[str | list[str]] = None,
+    task_id: Optional[str] = None,
+    city_type: Optional[str] = None,
+    city_name: Optional[str] = None,
+    job_run_id: Optional[int] = None,
+    concurrency: Optional[int] = None,
+    mode: Optional[str] = None,
+    stats: Optional[RunStats] = None,
+    force_refresh: bool = False,
+    adaptive_grid: Optional[bool] = None,
+):
+    """parser.collect_companies on the running event loop.
+
+    Up to concurrency units (ASYNC_UNIT_CONCURRENCY by default) run at once;
+    how many requests are on the wire is bounded process-wide per loop by
+    http_client.ASYNC_MAX_IN_FLIGHT and by the usual rate limiters.
+    """
+    if stats is None:
+        stats = RunStats()
+    keywords, options = _collect_options(keyword, mode, stats, force_refresh, adaptive_grid)
+    concurrency = concurrency if concurrency is not None else ASYNC_UNIT_CONCURRENCY
+    try:
+        if city_type == "manual" and city_name and states:
+            if not isinstance(states, str):
+                raise ValueError("A manually entered city needs exactly one state.")
+            try:
+                lat, lng = await resolve_city_async(city_name, states, stats=stats)
+            except Exception as e:
+                await _in_thread(log_status, task_id, f"Geocoding error: {str(e)}")
+                raise RuntimeError(f"Geocoding error: {str(e)}")
+            units = _manual_units(keywords, states, city_name, lat, lng, options["adaptive_grid"])
+        else:
+            # Logs unknown states, which opens the task's log file
+            units = await _in_thread(_location_units, keywords, states, city_type, city_name, options["adaptive_grid"], task_id)
+            if not units:
+                return
+
+        if job_run_id is None:
+            await _collect_units(units, task_id, job_run_id, concurrency, options)
+            return
+
+        units, deferred, running = await _in_thread(_plan_units, units, job_run_id, task_id, stats, force_refresh)
+        await _collect_units(units, task_id, job_run_id, concurrency, options)
+        for unit in deferred:
+            key = unit[4]
+            if await _wait_for(running[key], key):
+                await _in_thread(checkpoints.reuse, job_run_id, key, running[key])
+                metrics.incr("units_reused", stats=stats)
+            else:
+                await _in_thread(log_status, task_id, f"Job {running[key]} did not finish '{unit[0]}' for {unit[3]['city']}, {unit[1]}, collecting it here")
+                await _collect_units([unit], task_id, job_run_id, concurrency, options)
+    finally:
+        await _in_thread(log_status, task_id, f"HTTP calls ({options['mode']} mode, async): {stats.summary()}")
+
+async def _closing(coro):
+    try:
+        return await coro
+    finally:
+        await http_client.close_async_client()
+
+def run(coro, loop: Optional[asyncio.AbstractEventLoop] = None):
+    """Run a collector coroutine from a job worker thread and wait for it.
+
+    With the bot's running loop it is scheduled there and shares that loop's
+    client; otherwise it gets a loop of its own, closed afterwards.
+    """
+    if loop is not None and loop.is_running():
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+    return asyncio.run(_closing(coro))
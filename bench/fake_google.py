@@ -0,0 +1,256 @@
+import json
+import time
+import random
+import hashlib
+import threading
+import multiprocessing
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import urlparse
+
+# Local stand-in for the Places (New), Geocoding, Sheets and Drive endpoints
+# the collector and exporter use. Responses are synthetic, or replayed from a
+# recording, after a configurable delay; a share of Places/Geocoding calls
+# can fail with 503 to exercise the retry path.
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # socketserver's default backlog of 5 drops connects when an async
+    # client opens hundreds at once, and dropped SYNs are retried after 1s
+    request_queue_size = 1024
+
+class FakeGoogle:
+    def __init__(
+        self,
+        latency_ms: float = 50,
+        jitter_ms: float = 10,
+        error_rate: float = 0.0,
+        page_size: int = 20,
+        pages: int = 3,
+        sheets_latency_ms: float = 100,
+        replay: Optional[dict] = None,
+        seed: int = 0,
+    ):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.page_size = page_size
+        self.pages = pages
+        self.sheets_latency_ms = sheets_latency_ms
+        # {"searchText": [...], "details": [...], "geocode": [...]}, served round-robin
+        self.replay = replay or {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counts: dict[str, int] = {}
+        self.sheet_rows = 0
+        self._server: Optional[_Server] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> str:
+        fake = self
+
+        class Handler(_Handler):
+            server_fake = fake
+
+        self._server = _Server(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, name="fake-google", daemon=True).start()
+        return self.base_url
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def _count(self, name: str) -> int:
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+            return self.counts[name]
+
+    def _sleep(self, latency_ms: float):
+        with self._lock:
+            delay = latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+    def _fails(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def _replayed(self, endpoint: str, number: int) -> Optional[dict]:
+        responses = self.replay.get(endpoint)
+        return responses[(number - 1) % len(responses)] if responses else None
+
+    def search_text(self, body: dict, number: int) -> dict:
+        replayed = self._replayed("searchText", number)
+        if replayed is not None:
+            return replayed
+        rectangle = body.get("locationRestriction", {}).get("rectangle")
+        if rectangle:
+            lat = (rectangle["low"]["latitude"] + rectangle["high"]["latitude"]) / 2
+            lng = (rectangle["low"]["longitude"] + rectangle["high"]["longitude"]) / 2
+        else:
+            center = body.get("locationBias", {}).get("circle", {}).get("center", {})
+            lat, lng = center.get("latitude", 0.0), center.get("longitude", 0.0)
+        page = int(body.get("pageToken") or 0)
+        seed = f"{body.get('textQuery')}:{lat:.5f}:{lng:.5f}:{page}"
+        places = []
+        for index in range(self.page_size):
+            place_id = "bench_" + hashlib.sha1(f"{seed}:{index}".encode()).hexdigest()[:20]
+            places.append({
+                "id": place_id,
+                "displayName": {"text": f"Place {index}"},
+                "formattedAddress": f"{index} Main St",
+                "location": {"latitude": lat, "longitude": lng},
+            })
+        response = {"places": places}
+        if page + 1 < self.pages:
+            response["nextPageToken"] = str(page + 1)
+        return response
+
+    def details(self, place_id: str, number: int) -> dict:
+        replayed = self._replayed("details", number)
+        if replayed is not None:
+            return replayed
+        return {
+            "id": place_id,
+            "internationalPhoneNumber": "+1 555-0100",
+            "websiteUri": f"https://example.com/{place_id}",
+            "rating": 4.5,
+        }
+
+    def geocode(self, number: int) -> dict:
+        replayed = self._replayed("geocode", number)
+        if replayed is not None:
+            return replayed
+        return {"status": "OK", "results": [{"geometry": {"location": {"lat": 40.0, "lng": -75.0}}}]}
+
+class _Handler(BaseHTTPRequestHandler):
+    server_fake: FakeGoogle
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes; with Nagle on, keep-alive clients wait out delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        return json.loads(raw) if raw else {}
+
+    def _reply(self, payload: dict, status: int = 200):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _places(self, endpoint: str) -> bool:
+        """Delay and maybe fail a Places/Geocoding call; True when it failed."""
+        fake = self.server_fake
+        fake._sleep(fake.latency_ms)
+        if fake._fails():
+            fake._count(f"{endpoint}_errors")
+            self._reply({"error": {"code": 503, "message": "injected"}}, 503)
+            return True
+        return False
+
+    def do_GET(self):
+        fake = self.server_fake
+        url = urlparse(self.path)
+        if url.path == "/_bench/counts":
+            with fake._lock:
+                self._reply({"counts": dict(fake.counts), "sheet_rows": fake.sheet_rows})
+        elif url.path.endswith("/geocode/json"):
+            number = fake._count("geocode")
+            if not self._places("geocode"):
+                self._reply(fake.geocode(number))
+        elif "/places/" in url.path:
+            number = fake._count("details")
+            if not self._places("details"):
+                self._reply(fake.details(url.path.rsplit("/", 1)[-1], number))
+        elif url.path.startswith("/sheets/"):
+            fake._count("sheets")
+            fake._sleep(fake.sheets_latency_ms)
+            if "/values/" in url.path:
+                # values.get of A1: an empty sheet
+                self._reply({"values": []})
+            else:
+                self._reply({"sheets": [{"properties": {
+                    "sheetId": 0,
+                    "title": "Sheet1",
+                    "gridProperties": {"rowCount": 1000, "columnCount": 26},
+                }}]})
+        else:
+            self._reply({"error": {"code": 404, "message": url.path}}, 404)
+
+    def do_POST(self):
+        fake = self.server_fake
+        url = urlparse(self.path)
+        body = self._body()
+        if url.path.endswith("/places:searchText"):
+            number = fake._count("searchText")
+            if not self._places("searchText"):
+                self._reply(fake.search_text(body, number))
+        elif url.path.startswith("/sheets/"):
+            fake._count("sheets")
+            fake._sleep(fake.sheets_latency_ms)
+            rows = sum(len(item.get("values", [])) for item in body.get("data", [])) + len(body.get("values", []))
+            with fake._lock:
+                fake.sheet_rows += rows
+            if url.path.rstrip("/").endswith("/spreadsheets"):
+                self._reply({"spreadsheetId": "bench"})
+            else:
+                self._reply({})
+        elif url.path.startswith("/drive/"):
+            fake._count("drive")
+            self._reply({"id": "bench-permission"})
+        else:
+            self._reply({"error": {"code": 404, "message": url.path}}, 404)
+
+def load_replay(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+def _serve(options: dict, ready):
+    fake = FakeGoogle(**options)
+    ready.put(fake.start())
+    threading.Event().wait()
+
+class FakeGoogleProcess:
+    """FakeGoogle in a child process, so serving requests does not compete
+    with the code under test for the GIL. Counters are read over HTTP."""
+    def __init__(self, **options):
+        self.options = options
+        self.base_url: Optional[str] = None
+        self._process: Optional[multiprocessing.Process] = None
+
+    def start(self) -> str:
+        ready = multiprocessing.Queue()
+        self._process = multiprocessing.Process(target=_serve, args=(self.options, ready), daemon=True)
+        self._process.start()
+        self.base_url = ready.get(timeout=30)
+        return self.base_url
+
+    def stop(self):
+        if self._process:
+            self._process.terminate()
+            self._process.join()
+
+    def _state(self) -> dict:
+        with urllib.request.urlopen(f"{self.base_url}/_bench/counts") as response:
+            return json.load(response)
+
+    @property
+    def counts(self) -> dict[str, int]:
+        return self._state()["counts"]
+
+    @property
+    def sheet_rows(self) -> int:
+        return self._state()["sheet_rows"]
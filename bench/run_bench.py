@@ -0,0 +1,237 @@
+"""Offline benchmark of the collector and the Sheets exporter.
+
+Runs collect_companies (or its async_collector twin with --backend async)
+and create_google_sheet end-to-end against the local
+stand-in in fake_google.py, so no API quota is spent, and reports calls/sec,
+rows/sec, p50/p99 latencies and peak Python memory per phase.
+
+    python bench/run_bench.py --states NY --latency-ms 50 --json out.json
+    python bench/run_bench.py --states NY --baseline out.json
+
+Everything else (CITY_WORKERS, DETAILS_WORKERS, HTTP_*, SHEETS_CHUNK_ROWS...)
+is read from the environment as usual. PLACES_QPS/GEOCODE_QPS default to 0
+here so the rate limiter does not cap the measurement; pass --qps to keep it.
+Peak memory comes from tracemalloc, which slows the collector down about
+threefold: compare runs made with the same flags, or time with --no-memory.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_google import FakeGoogle, FakeGoogleProcess, load_replay
+
+# Latencies reported for each phase, see metrics.Metrics
+COLLECT_OPS = ("searchText", "details", "geocode", "searchText:rate_limit_wait", "details:rate_limit_wait", "db_save")
+EXPORT_OPS = ("sheets",)
+# Numbers compared against --baseline; True when higher is better
+COMPARED = {"calls_per_second": True, "rows_per_second": True, "seconds": False, "peak_memory_mb": False}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--keyword", default="coffee", help="comma-separated keywords run as one batch job")
+    parser.add_argument("--states", default="NY", help="state code or ALL")
+    parser.add_argument("--city-type", default="all", choices=["large", "medium", "small", "all"])
+    parser.add_argument("--mode", default=None, choices=["single", "two_step"], help="defaults to COLLECT_MODE")
+    parser.add_argument("--backend", default="threads", choices=["threads", "async"], help="collect_companies or async_collector")
+    parser.add_argument("--latency-ms", type=float, default=50, help="Places/Geocoding response delay")
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--sheets-latency-ms", type=float, default=100)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of Places/Geocoding calls answered with 503")
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=3)
+    parser.add_argument("--replay", help="JSON file with recorded responses per endpoint")
+    parser.add_argument("--qps", type=float, default=0, help="PLACES_QPS/GEOCODE_QPS, 0 = unlimited")
+    parser.add_argument("--no-export", action="store_true")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc, which slows Python code down noticeably")
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--baseline", help="report from an earlier run to compare against")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--in-process", action="store_true", help="serve the stand-in from a thread of this process")
+    return parser.parse_args()
+
+def configure_environment(args, fake, workdir: str):
+    """Point the app at the stand-in and a scratch database; must run before importing it."""
+    base = fake.base_url
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        "CACHE_ENABLED": "0",
+        "GOOGLE_API_KEY": "bench",
+        # Never read, use_credentials() supplies a static token
+        "GOOGLE_CREDS_FILE": "bench-credentials.json",
+        "PLACES_API_URL": f"{base}/v1",
+        "GEOCODE_API_URL": f"{base}/maps/api/geocode/json",
+        "GOOGLE_API_BASE_URL": base,
+        "PLACES_QPS": str(args.qps),
+        "GEOCODE_QPS": str(args.qps),
+    })
+    os.environ.setdefault("HTTP_BACKOFF_BASE", "0.05")
+    # parser reads states.json and writes logs relative to the working directory
+    shutil.copy(os.path.join(REPO_DIR, "states.json"), workdir)
+    os.makedirs(os.path.join(workdir, "logs"), exist_ok=True)
+    os.chdir(workdir)
+
+def latency_report(before: dict, after: dict, ops) -> dict:
+    """p50/p99 (bucket upper bounds) of the observations made between two snapshots."""
+    import metrics
+    report = {}
+    for op in ops:
+        new = after.get(op)
+        if not new:
+            continue
+        old = before.get(op, {"count": 0, "sum": 0.0, "buckets": [0] * len(new["buckets"])})
+        histogram = metrics.Histogram()
+        histogram.buckets = [n - o for n, o in zip(new["buckets"], old["buckets"])]
+        histogram.count = new["count"] - old["count"]
+        histogram.sum = new["sum"] - old["sum"]
+        if histogram.count:
+            report[op] = {
+                "count": histogram.count,
+                "mean_ms": round(histogram.sum / histogram.count * 1000, 2),
+                "p50_ms": histogram.quantile(0.5) * 1000,
+                "p99_ms": histogram.quantile(0.99) * 1000,
+            }
+    return report
+
+def measure(phase, ops, calls_fn, rows_fn):
+    import metrics
+    before = metrics.registry.to_dict()["latency"]
+    calls_before = calls_fn()
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    started = time.perf_counter()
+    phase()
+    seconds = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+    calls = calls_fn() - calls_before
+    rows = rows_fn()
+    return {
+        "seconds": round(seconds, 3),
+        "calls": calls,
+        "calls_per_second": round(calls / seconds, 2) if seconds else 0.0,
+        "rows": rows,
+        "rows_per_second": round(rows / seconds, 2) if seconds else 0.0,
+        "peak_memory_mb": round(peak / 2**20, 2) if peak is not None else None,
+        "latency": latency_report(before, metrics.registry.to_dict()["latency"], ops),
+    }
+
+def compare(report: dict, baseline: dict):
+    print("\nAgainst baseline:")
+    changed = sorted(
+        key for key, value in report["args"].items()
+        if key not in ("json", "baseline") and baseline.get("args", {}).get(key) != value
+    )
+    if changed:
+        print(f"  note: the baseline was run with different {', '.join(changed)}")
+    for phase, numbers in report["phases"].items():
+        old_numbers = baseline.get("phases", {}).get(phase)
+        if not old_numbers:
+            continue
+        for key, higher_is_better in COMPARED.items():
+            old, new = old_numbers.get(key), numbers.get(key)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            better = (change > 0) == higher_is_better
+            print(f"  {phase:8} {key:18} {old:>12} -> {new:<12} {change:+7.1f}% {'better' if better else 'worse'}")
+
+def print_report(report: dict):
+    for phase, numbers in report["phases"].items():
+        print(
+            f"{phase:8} {numbers['seconds']:8.2f}s  calls={numbers['calls']} ({numbers['calls_per_second']}/s)  "
+            f"rows={numbers['rows']} ({numbers['rows_per_second']}/s)  peak={numbers['peak_memory_mb']} MB"
+        )
+        for op, latency in numbers["latency"].items():
+            print(f"           {op:26} n={latency['count']:<6} mean={latency['mean_ms']}ms p50<={latency['p50_ms']}ms p99<={latency['p99_ms']}ms")
+
+def main():
+    args = parse_args()
+    replay = load_replay(args.replay) if args.replay else None
+    options = dict(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        page_size=args.page_size,
+        pages=args.pages,
+        sheets_latency_ms=args.sheets_latency_ms,
+        replay=replay,
+        seed=args.seed,
+    )
+    fake = FakeGoogle(**options) if args.in_process else FakeGoogleProcess(**options)
+    fake.start()
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    configure_environment(args, fake, workdir)
+    if not args.no_memory:
+        tracemalloc.start()
+
+    from google.oauth2.credentials import Credentials
+    import google_auth
+    import parser as collector
+    from db import SessionLocal, Company
+    google_auth.use_credentials(Credentials(token="bench"))
+
+    def place_calls():
+        counts = fake.counts
+        return sum(counts.get(name, 0) for name in ("searchText", "details", "geocode"))
+
+    def stored_rows():
+        with SessionLocal() as db:
+            return db.query(Company).count()
+
+    keywords = [keyword.strip() for keyword in args.keyword.split(",") if keyword.strip()]
+    keyword = keywords[0] if len(keywords) == 1 else keywords
+    report = {"args": vars(args), "phases": {}}
+
+    def collect():
+        if args.backend == "async":
+            import async_collector
+            async_collector.run(async_collector.collect_companies_async(keyword, states=args.states, city_type=args.city_type, mode=args.mode))
+        else:
+            collector.collect_companies(keyword, states=args.states, city_type=args.city_type, mode=args.mode)
+
+    try:
+        report["phases"]["collect"] = measure(
+            collect,
+            COLLECT_OPS,
+            place_calls,
+            stored_rows,
+        )
+        if not args.no_export:
+            report["phases"]["export"] = measure(
+                lambda: collector.create_google_sheet(
+                    "bench",
+                    True,
+                    "bench@example.com",
+                    keyword,
+                    None if args.states == "ALL" else args.states,
+                    None if args.city_type == "all" else args.city_type,
+                    None,
+                ),
+                EXPORT_OPS,
+                lambda: fake.counts.get("sheets", 0),
+                lambda: fake.sheet_rows,
+            )
+        report["errors_injected"] = {name: count for name, count in fake.counts.items() if name.endswith("_errors")}
+    finally:
+        fake.stop()
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            compare(report, json.load(file))
+
+if __name__ == "__main__":
+    main()
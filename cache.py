@@ -0,0 +1,112 @@
+import os
+import json
+import hashlib
+import threading
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from dotenv import load_dotenv
+from sqlalchemy import delete, func, select
+from db import SessionLocal, ApiCache, insert_for
+import metrics
+
+logger = logging.getLogger(__name__)
+# Configuration
+load_dotenv()
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "1") == "1"
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "200000"))
+CACHE_EVICT_EVERY = int(os.getenv("CACHE_EVICT_EVERY", "500"))
+# TTL in seconds per endpoint
+CACHE_TTLS = {
+    "searchText": int(os.getenv("CACHE_TTL_SEARCH", str(7 * 24 * 3600))),
+    "details": int(os.getenv("CACHE_TTL_DETAILS", str(30 * 24 * 3600))),
+    "geocode": int(os.getenv("CACHE_TTL_GEOCODE", str(180 * 24 * 3600))),
+}
+
+# Rows per upsert statement, well below SQLite's bound parameter limit
+_WRITE_CHUNK = 200
+_lock = threading.Lock()
+_puts_since_evict = 0
+
+def make_key(endpoint: str, **parts) -> str:
+    raw = json.dumps([endpoint, parts], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+def _cutoff_iso(endpoint: str) -> str:
+    ttl = CACHE_TTLS.get(endpoint, 0)
+    return (_now() - timedelta(seconds=ttl)).isoformat(timespec="seconds")
+
+def get(endpoint: str, key: str, stats=None) -> Optional[dict]:
+    if not CACHE_ENABLED:
+        return None
+    with SessionLocal() as db:
+        entry = db.get(ApiCache, key)
+        if entry and entry.created_at >= _cutoff_iso(endpoint):
+            metrics.incr(f"cache_hit:{endpoint}", stats=stats)
+            return json.loads(entry.response)
+    metrics.incr(f"cache_miss:{endpoint}", stats=stats)
+    return None
+
+def put(endpoint: str, key: str, value: dict, pending: Optional[list] = None):
+    """Cache a response; with pending it is only collected there, see write and flush."""
+    if not CACHE_ENABLED:
+        return
+    entry = {
+        "key": key,
+        "endpoint": endpoint,
+        "response": json.dumps(value),
+        "created_at": _now().isoformat(timespec="seconds"),
+    }
+    if pending is not None:
+        pending.append(entry)
+        return
+    flush([entry])
+
+def write(db, entries: list[dict]):
+    """Upsert collected entries in the caller's transaction; call written() after its commit."""
+    # One row per key, a statement may not update the same row twice
+    rows = list({entry["key"]: entry for entry in entries}.values())
+    for start in range(0, len(rows), _WRITE_CHUNK):
+        statement = insert_for(ApiCache).values(rows[start:start + _WRITE_CHUNK])
+        db.execute(statement.on_conflict_do_update(
+            index_elements=["key"],
+            set_={"response": statement.excluded.response, "created_at": statement.excluded.created_at},
+        ))
+
+def flush(pending: list[dict]):
+    """Write and empty collected entries in one transaction of their own."""
+    if not pending:
+        return
+    with SessionLocal() as db:
+        write(db, pending)
+        db.commit()
+    written(len(pending))
+    pending.clear()
+
+def written(count: int):
+    """Count committed entries, trimming the table every CACHE_EVICT_EVERY of them."""
+    global _puts_since_evict
+    with _lock:
+        _puts_since_evict += count
+        run_evict = _puts_since_evict >= CACHE_EVICT_EVERY
+        if run_evict:
+            _puts_since_evict = 0
+    if run_evict:
+        evict()
+
+def evict():
+    """Drop expired entries, then the oldest ones above CACHE_MAX_ENTRIES."""
+    with SessionLocal() as db:
+        for endpoint in CACHE_TTLS:
+            db.execute(delete(ApiCache).where(
+                ApiCache.endpoint == endpoint,
+                ApiCache.created_at < _cutoff_iso(endpoint),
+            ).execution_options(synchronize_session=False))
+        total = db.scalar(select(func.count()).select_from(ApiCache))
+        if total > CACHE_MAX_ENTRIES:
+            oldest = select(ApiCache.key).order_by(ApiCache.created_at).limit(total - CACHE_MAX_ENTRIES)
+            db.execute(delete(ApiCache).where(ApiCache.key.in_(oldest)).execution_options(synchronize_session=False))
+        db.commit()
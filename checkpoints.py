@@ -0,0 +1,162 @@
+import os
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Optional
+from dotenv import load_dotenv
+from sqlalchemy import literal, select
+from db import SessionLocal, JobCheckpoint, JobRun, JobRunCompany, JobUnitCompany, insert_for
+
+# Checkpoints record how far each city of a job run got, so a job that is
+# re-queued after a crash or restart skips finished cities and continues
+# unfinished ones from the last stored page. Other jobs use them to plan
+# around units that were collected recently or are being collected now.
+
+# Configuration
+load_dotenv()
+# Units finished by another job within this many hours are reused instead of searched again
+PLANNER_MAX_AGE_HOURS = float(os.getenv("PLANNER_MAX_AGE_HOURS", "168"))
+# How long a job waits for a unit another job is collecting before collecting it itself
+PLANNER_WAIT_SECONDS = float(os.getenv("PLANNER_WAIT_SECONDS", "3600"))
+PLANNER_POLL_SECONDS = float(os.getenv("PLANNER_POLL_SECONDS", "5"))
+
+# Status of a job that is being collected right now, see jobqueue.RUNNING
+_RUNNING = "running"
+# Keeps IN lists well below SQLite's bound parameter limit
+_IN_CHUNK = 500
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+def _now_iso() -> str:
+    return _now().isoformat(timespec="seconds")
+
+def unit_key(keyword: str, state: Optional[str], city_type: Optional[str], city: Optional[str], adaptive_grid: bool = False) -> str:
+    """Identifies one search: the same key means the same requests to the Places API."""
+    key = f"{keyword.strip().lower()}:{state or ''}:{city_type or ''}:{city or ''}"
+    return key + ":adaptive" if adaptive_grid else key
+
+def _upsert(job_run_id: int, key: str, progress: Optional[str], done: int):
+    values = {"job_run_id": job_run_id, "unit_key": key, "progress": progress, "done": done, "updated_at": _now_iso()}
+    with SessionLocal() as db:
+        db.execute(
+            insert_for(JobCheckpoint)
+            .values(**values)
+            .on_conflict_do_update(index_elements=["job_run_id", "unit_key"], set_=values)
+        )
+        db.commit()
+
+def claim(job_run_id: int, keys: Iterable[str]):
+    """Mark units as being collected by a job before it starts them.
+
+    Other jobs planning meanwhile wait for these units instead of searching
+    them too. Units that already have a checkpoint keep their progress.
+    """
+    now = _now_iso()
+    values = [{"job_run_id": job_run_id, "unit_key": key, "progress": None, "done": 0, "updated_at": now} for key in keys]
+    with SessionLocal() as db:
+        for start in range(0, len(values), _IN_CHUNK):
+            db.execute(
+                insert_for(JobCheckpoint)
+                .values(values[start:start + _IN_CHUNK])
+                .on_conflict_do_nothing(index_elements=["job_run_id", "unit_key"])
+            )
+        db.commit()
+
+def completed_units(job_run_id: int) -> set[str]:
+    with SessionLocal() as db:
+        rows = db.query(JobCheckpoint.unit_key).filter(JobCheckpoint.job_run_id == job_run_id, JobCheckpoint.done == 1)
+        return {row[0] for row in rows}
+
+def load(job_run_id: int, key: str) -> Optional[dict]:
+    """Progress saved by save() for an unfinished unit, or None."""
+    with SessionLocal() as db:
+        checkpoint = (
+            db.query(JobCheckpoint)
+            .filter(JobCheckpoint.job_run_id == job_run_id, JobCheckpoint.unit_key == key, JobCheckpoint.done == 0)
+            .first()
+        )
+        return json.loads(checkpoint.progress) if checkpoint and checkpoint.progress else None
+
+def save(job_run_id: int, key: str, tiles: list, page_token: Optional[str], tile_results: int):
+    """Store the tiles still to search; the first one continues at page_token."""
+    _upsert(job_run_id, key, json.dumps({"tiles": tiles, "page_token": page_token, "tile_results": tile_results}), 0)
+
+def mark_done(job_run_id: int, key: str):
+    _upsert(job_run_id, key, None, 1)
+
+def find_shared(job_run_id: int, keys: Iterable[str], max_age_hours: float = PLANNER_MAX_AGE_HOURS) -> tuple[dict[str, int], dict[str, int]]:
+    """Units of other jobs matching keys: (finished recently, being collected now).
+
+    Both map a unit key to the job run holding it; a finished unit wins over
+    a running one.
+    """
+    cutoff = (_now() - timedelta(hours=max_age_hours)).isoformat(timespec="seconds")
+    keys = list(keys)
+    finished: dict[str, tuple[str, int]] = {}
+    running: dict[str, int] = {}
+    with SessionLocal() as db:
+        for start in range(0, len(keys), _IN_CHUNK):
+            rows = (
+                db.query(JobCheckpoint.unit_key, JobCheckpoint.job_run_id, JobCheckpoint.done, JobCheckpoint.updated_at)
+                .join(JobRun, JobRun.id == JobCheckpoint.job_run_id)
+                .filter(
+                    JobCheckpoint.unit_key.in_(keys[start:start + _IN_CHUNK]),
+                    JobCheckpoint.job_run_id != job_run_id,
+                )
+                .filter(
+                    ((JobCheckpoint.done == 1) & (JobCheckpoint.updated_at >= cutoff))
+                    | ((JobCheckpoint.done == 0) & (JobRun.status == _RUNNING))
+                )
+            )
+            for key, other_job, done, updated_at in rows:
+                if done:
+                    # The most recently finished copy has the freshest links
+                    if key not in finished or updated_at > finished[key][0]:
+                        finished[key] = (updated_at, other_job)
+                else:
+                    running[key] = other_job
+    reusable = {key: other_job for key, (_, other_job) in finished.items()}
+    return reusable, {key: other_job for key, other_job in running.items() if key not in reusable}
+
+def reuse(job_run_id: int, key: str, source_job_run_id: int) -> int:
+    """Link the companies a unit found in another job to this job and mark the unit done."""
+    with SessionLocal() as db:
+        source = (JobUnitCompany.job_run_id == source_job_run_id, JobUnitCompany.unit_key == key)
+        linked = db.execute(
+            insert_for(JobRunCompany)
+            .from_select(["job_run_id", "company_id"], select(literal(job_run_id), JobUnitCompany.company_id).where(*source))
+            .on_conflict_do_nothing(index_elements=["job_run_id", "company_id"])
+        ).rowcount
+        # Recorded under this job as well, so its units stay reusable after the source ages out
+        db.execute(
+            insert_for(JobUnitCompany)
+            .from_select(["job_run_id", "unit_key", "company_id"], select(literal(job_run_id), literal(key), JobUnitCompany.company_id).where(*source))
+            .on_conflict_do_nothing(index_elements=["job_run_id", "unit_key", "company_id"])
+        )
+        db.commit()
+    mark_done(job_run_id, key)
+    return linked
+
+def unit_finished(source_job_run_id: int, key: str) -> Optional[bool]:
+    """True once another job finished a unit, False if it stopped without it, None while it runs."""
+    with SessionLocal() as db:
+        done = db.query(JobCheckpoint.done).filter(
+            JobCheckpoint.job_run_id == source_job_run_id,
+            JobCheckpoint.unit_key == key,
+        ).scalar()
+        status = db.query(JobRun.status).filter(JobRun.id == source_job_run_id).scalar()
+    if done:
+        return True
+    return None if status == _RUNNING else False
+
+def wait_for(source_job_run_id: int, key: str, timeout: float = PLANNER_WAIT_SECONDS) -> bool:
+    """Wait until another job finishes a unit; False if it stopped or timeout passed first."""
+    deadline = time.monotonic() + timeout
+    while True:
+        finished = unit_finished(source_job_run_id, key)
+        if finished is not None:
+            return finished
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(PLANNER_POLL_SECONDS)
@@ -1,11 +1,72 @@
-from sqlalchemy import Column, Integer, String, create_engine, Float, UniqueConstraint, ForeignKey, or_
+import os
+from dotenv import load_dotenv
+from sqlalchemy import Column, Integer, String, create_engine, event, inspect, text, Float, UniqueConstraint, ForeignKey, Index
 from sqlalchemy.orm import declarative_base, Session, sessionmaker, relationship
+from sqlalchemy.dialects import postgresql, sqlite
+
+# Configuration
+load_dotenv()
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///global.db")
+# "wal" - WAL journal with tuned pragmas, "default" - SQLite defaults
+SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "wal")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "30000"))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+# Connections kept open / opened on top under load, for SQLite files too. Together they
+# should cover JOB_WORKERS * CITY_WORKERS + DETAILS_WORKERS + ASYNC_DB_WORKERS + bot handlers
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+def _create_engine(url: str):
+    if url.startswith("sqlite"):
+        # In-memory databases use a single shared connection, not a queue pool
+        in_memory = url in ("sqlite://", "sqlite:///:memory:") or "mode=memory" in url
+        pool_args = {} if in_memory else {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW}
+        engine = create_engine(
+            url,
+            echo=False,
+            future=True,
+            **pool_args,
+            # Sessions are used from collector threads and bot executors
+            connect_args={"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000},
+        )
+
+        @event.listens_for(engine, "connect")
+        def _set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+            if SQLITE_PROFILE == "wal":
+                # Readers no longer block the writer and vice versa
+                cursor.execute("PRAGMA journal_mode=WAL")
+                cursor.execute("PRAGMA synchronous=NORMAL")
+                cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+                cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+                cursor.execute("PRAGMA temp_store=MEMORY")
+            cursor.close()
+
+        return engine
+    return create_engine(
+        url,
+        echo=False,
+        future=True,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+    )
 
 # DB setup
 Base = declarative_base()
-engine = create_engine("sqlite:///global.db", echo=False, future=True)
+engine = _create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(engine, expire_on_commit=False, class_=Session)
 
+def insert_for(model):
+    """INSERT for the current dialect, with on_conflict_do_nothing/do_update support."""
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
 # Email model
 class User(Base):
     __tablename__ = "user"
@@ -33,7 +94,16 @@ class Company(Base):
     keyword = Column(String)
     fetched_at = Column(String)
     updated_at = Column(String)
-    __table_args__ = (UniqueConstraint("place_id", name="uix_place"),)
+    # Normalized name and size class of the searched city, see parser.normalize_city_name
+    city = Column(String)
+    city_type = Column(String)
+    # Last time the details were fetched, see parser.refresh_companies
+    refreshed_at = Column(String)
+    __table_args__ = (
+        UniqueConstraint("place_id", name="uix_place"),
+        Index("ix_companies_keyword_state_city", "keyword", "state", "city"),
+        Index("ix_companies_keyword_city_type_state", "keyword", "city_type", "state"),
+    )
     # Relationship to JobRun through JobRunCompany
     job_runs = relationship("JobRunCompany", back_populates="company")
 
@@ -45,6 +115,15 @@ class JobRun(Base):
     params = Column(String)
     started_at = Column(String)
     finished_at = Column(String)
+    # Queue state, see jobqueue.py: queued -> running -> done/failed
+    status = Column(String)
+    priority = Column(Integer)
+    task_id = Column(String)
+    queued_at = Column(String)
+    error = Column(String)
+    # JSON counters and latency histograms of the run, see metrics.Metrics.to_dict
+    metrics = Column(String)
+    __table_args__ = (Index("ix_job_runs_status_priority", "status", "priority", "id"),)
     # Relationship back to User
     user_email = relationship("User", back_populates="job_runs")
     # Relationship to Company through JobRunCompany
@@ -64,4 +143,61 @@ class JobRunCompany(Base):
     # Unique constraint to prevent duplicate associations
     __table_args__ = (UniqueConstraint("job_run_id", "company_id", name="uix_job_run_company"),)
 
-Base.metadata.create_all(bind=engine)
\ No newline at end of file
+# Places already written to a spreadsheet, used to skip them on append
+class ExportedPlace(Base):
+    __tablename__ = "exported_places"
+    id = Column(Integer, primary_key=True)
+    spreadsheet_id = Column(String, nullable=False)
+    place_id = Column(String, nullable=False)
+    __table_args__ = (UniqueConstraint("spreadsheet_id", "place_id", name="uix_exported_place"),)
+
+# Progress of one city of a job run, see checkpoints.py
+class JobCheckpoint(Base):
+    __tablename__ = "job_checkpoints"
+    id = Column(Integer, primary_key=True)
+    job_run_id = Column(Integer, ForeignKey("job_runs.id"), nullable=False)
+    # "keyword:state:city_type:city[:adaptive]", see checkpoints.unit_key
+    unit_key = Column(String, nullable=False)
+    # JSON with the tiles still to search and the next page token, NULL once done
+    progress = Column(String)
+    done = Column(Integer, default=0)
+    updated_at = Column(String)
+    __table_args__ = (
+        UniqueConstraint("job_run_id", "unit_key", name="uix_job_checkpoint"),
+        # Lets other jobs find finished or running units, see checkpoints.find_shared
+        Index("ix_job_checkpoints_unit_key_done", "unit_key", "done"),
+    )
+
+# Companies found by each unit of a job run, so later jobs can reuse a unit's results
+class JobUnitCompany(Base):
+    __tablename__ = "job_unit_companies"
+    id = Column(Integer, primary_key=True)
+    job_run_id = Column(Integer, ForeignKey("job_runs.id"), nullable=False)
+    unit_key = Column(String, nullable=False)
+    company_id = Column(Integer, ForeignKey("companies.id"), nullable=False)
+    __table_args__ = (UniqueConstraint("job_run_id", "unit_key", "company_id", name="uix_job_unit_company"),)
+
+# Cached Google API responses, see cache.py
+class ApiCache(Base):
+    __tablename__ = "api_cache"
+    key = Column(String, primary_key=True)
+    endpoint = Column(String, index=True)
+    response = Column(String)
+    created_at = Column(String, index=True)
+
+Base.metadata.create_all(bind=engine)
+
+def _migrate():
+    """Add columns and indexes introduced after a table was first created."""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"))
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+_migrate()
\ No newline at end of file
@@ -1,11 +1,18 @@
 import os
+import threading
+from datetime import datetime, timedelta, timezone
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
 import pickle
 from dotenv import load_dotenv
 load_dotenv()
 CRED = os.getenv("GOOGLE_CREDS_FILE")
+# Refresh the access token this long before it actually expires
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.getenv("TOKEN_REFRESH_MARGIN_SECONDS", "300"))
+# Sends Sheets/Drive requests to <url>/<api name>/ instead of Google, used by bench/
+GOOGLE_API_BASE_URL = os.getenv("GOOGLE_API_BASE_URL")
 
 # If modifying these scopes, delete the token.pickle file.
 SCOPES = [
@@ -13,13 +20,24 @@ SCOPES = [
     'https://www.googleapis.com/auth/drive'
 ]
 
-def get_credentials():
+# Credentials are shared by the whole process; the lock also serializes
+# refreshes and token.pickle writes
+_creds_lock = threading.Lock()
+_creds = None
+# Built services wrap a non thread-safe httplib2 connection, so they are cached per thread
+_local = threading.local()
+
+def _save_credentials(creds):
+    with open('token.pickle', 'wb') as token:
+        pickle.dump(creds, token)
+
+def _load_credentials():
     creds = None
     # The file token.pickle stores the user's access and refresh tokens.
     if os.path.exists('token.pickle'):
         with open('token.pickle', 'rb') as token:
             creds = pickle.load(token)
-    
+
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
@@ -28,9 +46,47 @@ def get_credentials():
             flow = InstalledAppFlow.from_client_secrets_file(
                 CRED, SCOPES)
             creds = flow.run_local_server(port=0)
-        
+
         # Save the credentials for the next run
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
-    
-    return creds
\ No newline at end of file
+        _save_credentials(creds)
+
+    return creds
+
+def _expires_soon(creds) -> bool:
+    if not creds.valid:
+        return True
+    if creds.expiry is None:
+        return False
+    # google-auth keeps expiry as a naive UTC datetime
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return creds.expiry - now < timedelta(seconds=TOKEN_REFRESH_MARGIN_SECONDS)
+
+def get_credentials():
+    global _creds
+    with _creds_lock:
+        if _creds is None:
+            _creds = _load_credentials()
+        elif _expires_soon(_creds) and _creds.refresh_token:
+            _creds.refresh(Request())
+            _save_credentials(_creds)
+        return _creds
+
+def use_credentials(creds):
+    """Replace the process credentials, e.g. with a static token for a local stand-in."""
+    global _creds
+    with _creds_lock:
+        _creds = creds
+
+def get_service(name: str, version: str):
+    """Built Google API client for this thread, with up-to-date credentials."""
+    creds = get_credentials()
+    services = getattr(_local, "services", None)
+    if services is None:
+        services = _local.services = {}
+    cached = services.get((name, version))
+    # Credentials are refreshed in place, so a service only needs rebuilding if they were replaced
+    if cached is None or cached[0] is not creds:
+        client_options = {"api_endpoint": f"{GOOGLE_API_BASE_URL.rstrip('/')}/{name}/"} if GOOGLE_API_BASE_URL else None
+        cached = (creds, build(name, version, credentials=creds, cache_discovery=False, client_options=client_options))
+        services[(name, version)] = cached
+    return cached[1]
@@ -0,0 +1,232 @@
+import os
+import math
+import time
+import random
+import asyncio
+import weakref
+import itertools
+import threading
+import logging
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Optional
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+import metrics
+
+logger = logging.getLogger(__name__)
+# Configuration
+load_dotenv()
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "5"))
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.5"))
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "30"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))
+# Process-wide request budgets, 0 disables the limit
+PLACES_QPS = float(os.getenv("PLACES_QPS", "10"))
+PLACES_BURST = float(os.getenv("PLACES_BURST", "20"))
+GEOCODE_QPS = float(os.getenv("GEOCODE_QPS", "10"))
+GEOCODE_BURST = float(os.getenv("GEOCODE_BURST", "10"))
+# Requests in flight at once on one event loop's async clients
+ASYNC_MAX_IN_FLIGHT = int(os.getenv("ASYNC_MAX_IN_FLIGHT", "256"))
+# Connections per async client; httpx's pool bookkeeping grows with the square
+# of its size, so the in-flight requests are spread over several small pools
+ASYNC_POOL_SIZE = int(os.getenv("ASYNC_POOL_SIZE", "8"))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    """Thread-safe token bucket shared by every collector thread and coroutine.
+
+    Callers reserve a token even when the bucket is empty and sleep off the
+    debt outside the lock, so waiting callers are served in arrival order.
+    """
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = max(1.0, burst)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """Take the tokens and return how long to wait before using them."""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, tokens: float = 1.0) -> float:
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+places_limiter = TokenBucket(PLACES_QPS, PLACES_BURST)
+geocode_limiter = TokenBucket(GEOCODE_QPS, GEOCODE_BURST)
+
+# requests.Session is not guaranteed to be thread-safe, so each thread keeps
+# its own pooled session and reuses its keep-alive connections
+_local = threading.local()
+
+def get_session() -> requests.Session:
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _local.session = session
+    return session
+
+def _retry_after_seconds(response: requests.Response | httpx.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+def _backoff_seconds(attempt: int) -> float:
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)))
+
+def request(method: str, url: str, stats=None, timeout: Optional[float] = None, limiter: Optional[TokenBucket] = None, metric: Optional[str] = None, **kwargs) -> requests.Response:
+    """Send a request on the pooled session, retrying 429/5xx and connection errors.
+
+    Every attempt, retries included, first takes a token from ``limiter``.
+    With ``metric`` set, attempt latencies and time spent waiting for the
+    limiter or a retry are recorded under that name.
+
+    The last response is returned as-is once retries run out, so callers keep
+    handling non-200 statuses themselves. Connection errors are re-raised.
+    """
+    timeout = timeout if timeout is not None else HTTP_TIMEOUT
+    attempt = 0
+    while True:
+        if limiter:
+            waited = limiter.acquire()
+            if metric:
+                metrics.observe(f"{metric}:rate_limit_wait", waited, stats)
+        started = time.perf_counter()
+        try:
+            response = get_session().request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= HTTP_MAX_RETRIES:
+                raise
+            delay = _backoff_seconds(attempt)
+            logger.warning(f"{method} {url} failed ({e}), retry {attempt + 1} in {delay:.2f}s")
+        else:
+            if metric:
+                metrics.observe(metric, time.perf_counter() - started, stats)
+            if response.status_code not in RETRY_STATUSES or attempt >= HTTP_MAX_RETRIES:
+                return response
+            retry_after = _retry_after_seconds(response)
+            delay = retry_after if retry_after is not None else _backoff_seconds(attempt)
+            logger.warning(f"{method} {url} returned {response.status_code}, retry {attempt + 1} in {delay:.2f}s")
+        metrics.incr("retries", stats=stats)
+        if metric:
+            metrics.observe(f"{metric}:retry_wait", delay, stats)
+        attempt += 1
+        time.sleep(delay)
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
+
+class _AsyncClients:
+    """httpx clients of one event loop, used round-robin, and its in-flight bound."""
+    def __init__(self):
+        pool_size = max(1, min(ASYNC_POOL_SIZE, ASYNC_MAX_IN_FLIGHT))
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        # The semaphore bounds in-flight requests, so waiting for a pooled connection needs no timeout
+        timeout = httpx.Timeout(HTTP_TIMEOUT, pool=None)
+        self.clients = [
+            httpx.AsyncClient(limits=limits, timeout=timeout)
+            for _ in range(math.ceil(max(1, ASYNC_MAX_IN_FLIGHT) / pool_size))
+        ]
+        self._next = itertools.cycle(self.clients)
+        self.in_flight = asyncio.Semaphore(max(1, ASYNC_MAX_IN_FLIGHT))
+
+    def pick(self) -> httpx.AsyncClient:
+        return next(self._next)
+
+# Shared clients per event loop: the bot's loop keeps them for the life of
+# the process, a loop made by asyncio.run() closes its own on exit
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _AsyncClients]" = weakref.WeakKeyDictionary()
+
+def _get_async_clients() -> _AsyncClients:
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.get(loop)
+    if clients is None:
+        clients = _async_clients[loop] = _AsyncClients()
+    return clients
+
+async def close_async_client():
+    """Close the running loop's clients, if it has any."""
+    clients = _async_clients.pop(asyncio.get_running_loop(), None)
+    if clients:
+        await asyncio.gather(*(client.aclose() for client in clients.clients))
+
+async def request_async(method: str, url: str, stats=None, timeout: Optional[float] = None, limiter: Optional[TokenBucket] = None, metric: Optional[str] = None, **kwargs) -> httpx.Response:
+    """request() for coroutines, on the running loop's shared httpx clients.
+
+    Same limiter, retries and metrics; at most ASYNC_MAX_IN_FLIGHT requests
+    of the loop are on the wire at once, waits for the limiter or a retry do
+    not count. Connection errors and timeouts are re-raised as httpx errors.
+    """
+    clients = _get_async_clients()
+    timeout = timeout if timeout is not None else HTTP_TIMEOUT
+    attempt = 0
+    while True:
+        if limiter:
+            waited = await limiter.acquire_async()
+            if metric:
+                metrics.observe(f"{metric}:rate_limit_wait", waited, stats)
+        try:
+            async with clients.in_flight:
+                started = time.perf_counter()
+                response = await clients.pick().request(method, url, timeout=timeout, **kwargs)
+        except httpx.TransportError as e:
+            if attempt >= HTTP_MAX_RETRIES:
+                raise
+            delay = _backoff_seconds(attempt)
+            logger.warning(f"{method} {url} failed ({e!r}), retry {attempt + 1} in {delay:.2f}s")
+        else:
+            if metric:
+                metrics.observe(metric, time.perf_counter() - started, stats)
+            if response.status_code not in RETRY_STATUSES or attempt >= HTTP_MAX_RETRIES:
+                return response
+            retry_after = _retry_after_seconds(response)
+            delay = retry_after if retry_after is not None else _backoff_seconds(attempt)
+            logger.warning(f"{method} {url} returned {response.status_code}, retry {attempt + 1} in {delay:.2f}s")
+        metrics.incr("retries", stats=stats)
+        if metric:
+            metrics.observe(f"{metric}:retry_wait", delay, stats)
+        attempt += 1
+        await asyncio.sleep(delay)
+
+async def get_async(url: str, **kwargs) -> httpx.Response:
+    return await request_async("GET", url, **kwargs)
+
+async def post_async(url: str, **kwargs) -> httpx.Response:
+    return await request_async("POST", url, **kwargs)
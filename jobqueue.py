@@ -0,0 +1,253 @@
+import os
+import json
+import asyncio
+import time
+import uuid
+import threading
+import traceback
+import logging
+from datetime import datetime, timezone
+from typing import Callable, Optional
+from dotenv import load_dotenv
+from sqlalchemy import func, update
+from db import SessionLocal, User, JobRun
+from parser import CollectorTask, collect_companies, refresh_companies, log_status, tasks
+import async_collector
+
+logger = logging.getLogger(__name__)
+# Configuration
+load_dotenv()
+# Jobs executed at the same time by this process
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Running jobs allowed per user, the rest wait in the queue
+JOB_USER_CONCURRENCY = int(os.getenv("JOB_USER_CONCURRENCY", "1"))
+# Idle workers re-check the queue this often even without a wakeup
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "5"))
+# "threads" - city and details thread pools, "async" - coroutines on an event loop (async_collector)
+COLLECTOR_BACKEND = os.getenv("COLLECTOR_BACKEND", "threads")
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+def job_priority(state: Optional[str | list[str]], city_type: Optional[str], city_name: Optional[str]) -> int:
+    """Lower runs first: one city, then one state, then nationwide jobs."""
+    if city_name:
+        return 0
+    states = state if isinstance(state, list) else [state]
+    nationwide = not states or None in states or "ALL" in states
+    all_types = not city_type or city_type == "all"
+    return 1 + 2 * nationwide + all_types
+
+class JobQueue:
+    """Runs queued JobRun rows on a fixed pool of worker threads.
+
+    The queue itself lives in the job_runs table, so jobs that were queued
+    or running when the process stopped are picked up again on start().
+    """
+    def __init__(self, workers: int = JOB_WORKERS, per_user: int = JOB_USER_CONCURRENCY):
+        self.workers = workers
+        self.per_user = per_user
+        self._wakeup = threading.Condition()
+        # Claiming reads the per-user running counts first, so claims are serialized
+        self._claim_lock = threading.Lock()
+        self._threads: list[threading.Thread] = []
+        self._listeners: list[Callable[[CollectorTask, str], None]] = []
+        self._callbacks: dict[int, Callable[[CollectorTask], None]] = {}
+        self._finished: dict[str, threading.Event] = {}
+        self._stopped = False
+        # Event loop async jobs are scheduled on, see use_loop()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def add_listener(self, listener: Callable[[CollectorTask, str], None]):
+        """Called from a worker thread with the task and the user's Telegram id after every job."""
+        self._listeners.append(listener)
+
+    def use_loop(self, loop: asyncio.AbstractEventLoop):
+        """Run async collector jobs on loop, e.g. the bot's, instead of a loop per job."""
+        self.loop = loop
+
+    def start(self):
+        if self._threads:
+            return
+        with SessionLocal() as db:
+            # Jobs cut off by a restart go back to the queue
+            resumed = db.execute(
+                update(JobRun).where(JobRun.status == RUNNING).values(status=QUEUED)
+            ).rowcount
+            db.commit()
+        if resumed:
+            logger.info(f"Re-queued {resumed} interrupted job(s)")
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopped = True
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    def submit(self, user_id: str, params: dict, on_done: Optional[Callable[[CollectorTask], None]] = None) -> tuple[int, str]:
+        """Queue a job for the user and return its (job_run_id, task_id)."""
+        task_id = str(uuid.uuid4())
+        with SessionLocal() as db:
+            user = db.query(User).filter_by(user_id=user_id).first() if user_id else None
+            if not user:
+                raise ValueError(f"User with user_id={user_id} not found in database.")
+            job_run = JobRun(
+                user_email_id=user.id,
+                params=json.dumps(params),
+                started_at=None,
+                finished_at=None,
+                status=QUEUED,
+                priority=job_priority(params.get("state"), params.get("city_type"), params.get("city_name")),
+                task_id=task_id,
+                queued_at=_now_iso(),
+            )
+            db.add(job_run)
+            db.commit()
+            job_run_id = job_run.id
+        if on_done:
+            self._callbacks[job_run_id] = on_done
+        self._finished[task_id] = threading.Event()
+        log_status(task_id, f"Task {task_id} queued at {_now_iso()}")
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_run_id, task_id
+
+    def wait(self, task_id: str, timeout: Optional[float] = None) -> bool:
+        event = self._finished.get(task_id)
+        return event.wait(timeout) if event else True
+
+    def _claim(self) -> Optional[int]:
+        with self._claim_lock, SessionLocal() as db:
+            running = dict(
+                db.query(JobRun.user_email_id, func.count(JobRun.id))
+                .filter(JobRun.status == RUNNING)
+                .group_by(JobRun.user_email_id)
+                .all()
+            )
+            # Users at their cap are left out before the window is cut, so a user with
+            # a long backlog cannot hide everybody else's jobs
+            capped = [user_email_id for user_email_id, count in running.items() if count >= self.per_user]
+            queued = (
+                db.query(JobRun.id, JobRun.user_email_id, JobRun.priority)
+                .filter(JobRun.status == QUEUED, JobRun.user_email_id.notin_(capped))
+                .order_by(JobRun.priority, JobRun.id)
+                .limit(100)
+                .all()
+            )
+            # Within a priority, users with fewer running jobs go first
+            for job_id, user_email_id, _ in sorted(queued, key=lambda job: (job.priority, running.get(job.user_email_id, 0), job.id)):
+                claimed = db.execute(
+                    update(JobRun)
+                    .where(JobRun.id == job_id, JobRun.status == QUEUED)
+                    .values(status=RUNNING, started_at=func.coalesce(JobRun.started_at, _now_iso()))
+                ).rowcount
+                db.commit()
+                if claimed:
+                    return job_id
+        return None
+
+    def _work(self):
+        while not self._stopped:
+            job_id = self._claim()
+            if job_id is None:
+                with self._wakeup:
+                    self._wakeup.wait(JOB_POLL_SECONDS)
+                continue
+            self._run(job_id)
+            # A finished job may unblock another job of the same user
+            with self._wakeup:
+                self._wakeup.notify_all()
+
+    def _run(self, job_id: int):
+        with SessionLocal() as db:
+            job_run = db.get(JobRun, job_id)
+            params = json.loads(job_run.params)
+            user_id = job_run.user_email.user_id
+            task = CollectorTask(params.get("keyword"), params.get("state"), task_id=job_run.task_id)
+        task.job_run_id = job_id
+        tasks[task.id] = task
+        log_status(task.id, f"Task {task.id} started at {_now_iso()}")
+        start_time = time.time()
+        error = None
+        try:
+            run_job(task, params, self.loop)
+            task.status = DONE
+        except Exception as e:
+            tb = traceback.format_exc()
+            log_status(task.id, f"Error occured: {str(e)}\n{tb}")
+            task.status = f"failed: {str(e)}"
+            error = str(e)
+        finally:
+            with SessionLocal() as db:
+                db.execute(
+                    update(JobRun)
+                    .where(JobRun.id == job_id)
+                    .values(
+                        status=DONE if error is None else FAILED,
+                        error=error,
+                        finished_at=_now_iso(),
+                        metrics=json.dumps(task.stats.to_dict()),
+                    )
+                )
+                db.commit()
+            # /stats reads finished jobs from job_runs.metrics from here on
+            tasks.pop(task.id, None)
+            elapsed = time.time() - start_time
+            log_status(task.id, f"Task {task.id} finished with status: {task.status} in {elapsed:.2f} seconds")
+        self._notify(task, user_id)
+
+    def _notify(self, task: CollectorTask, user_id: str):
+        on_done = self._callbacks.pop(task.job_run_id, None)
+        if on_done:
+            self._call_safely(on_done, task)
+        for listener in self._listeners:
+            self._call_safely(listener, task, user_id)
+        event = self._finished.pop(task.id, None)
+        if event:
+            event.set()
+
+    def _call_safely(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception:
+            logger.exception(f"Completion callback failed for task {args[0].id}")
+
+def run_job(task: CollectorTask, params: dict, loop: Optional[asyncio.AbstractEventLoop] = None):
+    if params.get("type") == "refresh":
+        refresh_companies(
+            keyword=params.get("keyword"),
+            state=params.get("state"),
+            max_age_days=params.get("max_age_days"),
+            task_id=task.id,
+            job_run_id=task.job_run_id,
+            stats=task.stats,
+        )
+        return
+    options = dict(
+        # Batch jobs carry the keyword list, "keyword" is then only for display
+        keyword=params.get("keywords") or params["keyword"],
+        states=params.get("state"),
+        task_id=task.id,
+        city_type=params.get("city_type"),
+        city_name=params.get("city_name"),
+        job_run_id=task.job_run_id,
+        mode=params.get("mode"),
+        force_refresh=params.get("force_refresh", False),
+        adaptive_grid=params.get("adaptive_grid"),
+        stats=task.stats,
+    )
+    if COLLECTOR_BACKEND == "async":
+        # The worker thread only waits, the job's calls all run on the loop
+        async_collector.run(async_collector.collect_companies_async(**options), loop)
+    else:
+        collect_companies(**options)
+
+job_queue = JobQueue()
@@ -1,10 +1,13 @@
 import os
 import re
+import asyncio
 from dotenv import load_dotenv
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters, CallbackQueryHandler
 import logging
-from searchdialog import handle_sheet_overwrite, search_handler, handle_text_response, handle_callback_query
+from searchdialog import handle_sheet_overwrite, search_handler, refresh_handler, stats_handler, handle_text_response, handle_callback_query, register_job_notifications
+from parser import backfill_company_cities
+import metrics
 
 from userauth import get_user_email
 
@@ -19,14 +22,16 @@ logger = logging.getLogger(__name__)
 # Command /start
 async def command_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = str(update.effective_user.id)
-    email = get_user_email(user_id)
+    email = await asyncio.to_thread(get_user_email, user_id)
     email_status = email if email else "Not set"
     message = (
         "ℹ️ Info center\n"
         f"Email status: {'✅' if email else '❌'}\n"
         f"{email_status}\n\n"
         "/setemail - set new or update current email\n\n"
-        "Main commands:\n/search - main function"
+        "Main commands:\n/search - main function\n"
+        "/refresh <keyword> [STATE] - update phone, website and rating of stored companies\n"
+        "/stats - metrics of your latest job"
     )
     await update.message.reply_text(message)
 
@@ -37,15 +42,26 @@ async def command_setemail(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
 
 
+async def post_init(app: Application) -> None:
+    # Starts the job workers, resuming jobs interrupted by the last shutdown
+    register_job_notifications(app)
+
 # Init bot
 def main():
+    # Older rows predate the city/city_type export columns
+    backfill_company_cities()
+    # Prometheus endpoint, only when METRICS_PORT is set
+    metrics.start_server()
 
-    app = Application.builder().token(BOT_TOKEN).build()
+    # Handlers only await I/O, so updates from different users are processed concurrently
+    app = Application.builder().token(BOT_TOKEN).concurrent_updates(True).post_init(post_init).build()
 
     # Command handlers
     app.add_handler(CommandHandler("start", command_start))
     app.add_handler(CommandHandler("setemail", command_setemail))
     app.add_handler(CommandHandler("search", search_handler))  
+    app.add_handler(CommandHandler("refresh", refresh_handler))
+    app.add_handler(CommandHandler("stats", stats_handler))
 
     # Text messages
     app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_text_response))
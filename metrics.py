@@ -0,0 +1,175 @@
+import os
+import time
+import bisect
+import threading
+import logging
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+# Configuration
+load_dotenv()
+# Port of the Prometheus text endpoint, 0 disables it
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Upper bounds in seconds, shared by every latency histogram
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram:
+    def __init__(self):
+        # One slot per bucket plus +Inf
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": list(self.buckets),
+        }
+
+class Metrics:
+    """Thread-safe counters and latency histograms.
+
+    With a parent every count and observation is also recorded there, which
+    is how per-run stats feed the process-wide registry.
+    """
+    def __init__(self, parent: Optional["Metrics"] = None):
+        self._lock = threading.Lock()
+        self.parent = parent
+        self.started = time.time()
+        self.counts: dict[str, int] = {}
+        self.latencies: dict[str, Histogram] = {}
+
+    def incr(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+        if self.parent:
+            self.parent.incr(name, amount)
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            histogram = self.latencies.get(name)
+            if histogram is None:
+                histogram = self.latencies[name] = Histogram()
+            histogram.observe(seconds)
+        if self.parent:
+            self.parent.observe(name, seconds)
+
+    def snapshot(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self.counts)
+
+    def to_dict(self) -> dict:
+        """JSON-friendly copy of everything recorded, as stored in JobRun.metrics."""
+        with self._lock:
+            elapsed = time.time() - self.started
+            return {
+                "elapsed_seconds": round(elapsed, 3),
+                "rows_per_second": round(self.counts.get("rows_saved", 0) / elapsed, 3) if elapsed > 0 else 0.0,
+                "counts": dict(self.counts),
+                "latency": {name: histogram.to_dict() for name, histogram in self.latencies.items()},
+            }
+
+# Everything recorded by this process since it started
+registry = Metrics()
+
+def incr(name: str, amount: int = 1, stats: Optional[Metrics] = None):
+    (stats or registry).incr(name, amount)
+
+def observe(name: str, seconds: float, stats: Optional[Metrics] = None):
+    (stats or registry).observe(name, seconds)
+
+@contextmanager
+def timed(name: str, stats: Optional[Metrics] = None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, stats)
+
+def summarize(data: dict) -> str:
+    """Readable summary of a to_dict() result, used by the /stats command."""
+    lines = [f"Elapsed: {data.get('elapsed_seconds', 0):.1f}s, rows/s: {data.get('rows_per_second', 0):.2f}"]
+    counts = data.get("counts", {})
+    if counts:
+        lines.append(", ".join(f"{name}={count}" for name, count in sorted(counts.items())))
+    for name, latency in sorted(data.get("latency", {}).items()):
+        lines.append(
+            f"{name}: n={latency['count']} total={latency['sum']:.1f}s p50<={latency['p50']}s p99<={latency['p99']}s"
+        )
+    return "\n".join(lines)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def render_prometheus(metrics: Metrics = registry) -> str:
+    """The metrics in the Prometheus text exposition format."""
+    data = metrics.to_dict()
+    lines = [
+        "# HELP collector_events_total Events counted by the collector (API calls, retries, cache hits, rows).",
+        "# TYPE collector_events_total counter",
+    ]
+    for name, count in sorted(data["counts"].items()):
+        lines.append(f'collector_events_total{{name="{_escape(name)}"}} {count}')
+    lines += [
+        "# HELP collector_latency_seconds Duration of API calls, waits, DB saves and Sheets requests.",
+        "# TYPE collector_latency_seconds histogram",
+    ]
+    for name, latency in sorted(data["latency"].items()):
+        label = _escape(name)
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), latency["buckets"]):
+            cumulative += count
+            lines.append(f'collector_latency_seconds_bucket{{op="{label}",le="{bound}"}} {cumulative}')
+        lines.append(f'collector_latency_seconds_sum{{op="{label}"}} {latency["sum"]}')
+        lines.append(f'collector_latency_seconds_count{{op="{label}"}} {latency["count"]}')
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would flood the bot's log otherwise
+        pass
+
+def start_server(port: int = METRICS_PORT, host: str = METRICS_HOST) -> Optional[ThreadingHTTPServer]:
+    """Serve /metrics on a daemon thread; does nothing when port is 0."""
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Metrics available at http://{host}:{port}/metrics")
+    return server
@@ -1,20 +1,29 @@
 import os
+import re
 import time
+import difflib
+import unicodedata
 import uuid
 import math
-from datetime import datetime, timezone
-from typing import Optional
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
 from dotenv import load_dotenv
 import requests
-from db import SessionLocal, Company, Session, or_, User, JobRun, JobRunCompany
+import http_client
+import cache
+import sheets
+import checkpoints
+import metrics
+from db import SessionLocal, Company, Session, JobRunCompany, JobUnitCompany, ExportedPlace, insert_for
 import threading
-import traceback
 import json
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
+import itertools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from sqlalchemy import delete, func, literal, select, update
 import logging
 
-from google_auth import get_credentials
+from google_auth import get_service
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO  # You can change this to DEBUG for more verbosity
@@ -23,10 +32,34 @@ logger = logging.getLogger(__name__)
 # Configuration
 load_dotenv()
 API_KEY = os.getenv("GOOGLE_API_KEY")
+# API locations, overridden by the benchmark's local stand-in (bench/)
+PLACES_API_URL = os.getenv("PLACES_API_URL", "https://places.googleapis.com/v1").rstrip("/")
+GEOCODE_API_URL = os.getenv("GEOCODE_API_URL", "https://maps.googleapis.com/maps/api/geocode/json")
 LARGE_RADIUS_METERS = int(os.getenv("LARGE_RADIUS_METERS", "50000"))
 MEDIUM_RADIUS_METERS = int(os.getenv("MEDIUM_RADIUS_METERS", "30000"))
 SMALL_RADIUS_METERS = int(os.getenv("SMALL_RADIUS_METERS", "10000"))
-REQUEST_DELAY = float(os.getenv("REQUEST_DELAY", "2.0"))
+# How many cities are collected at the same time within one job
+CITY_WORKERS = int(os.getenv("CITY_WORKERS", "4"))
+# Max place-details requests in flight across the whole process
+DETAILS_WORKERS = int(os.getenv("DETAILS_WORKERS", "8"))
+# "two_step" - searchText + place details per new place, "single" - one searchText call
+COLLECT_MODE = os.getenv("COLLECT_MODE", "two_step")
+# Split a search circle into quadrant tiles while it returns a full result set
+ADAPTIVE_GRID = os.getenv("ADAPTIVE_GRID", "0") == "1"
+# searchText returns at most 3 pages of 20 places
+GRID_FULL_RESULTS = int(os.getenv("GRID_FULL_RESULTS", "60"))
+# Smallest half-side of a sub-tile
+GRID_MIN_RADIUS_METERS = int(os.getenv("GRID_MIN_RADIUS_METERS", "2000"))
+GRID_MAX_DEPTH = int(os.getenv("GRID_MAX_DEPTH", "4"))
+METERS_PER_DEGREE = 111320
+# Minimum similarity (0..1) for a typed city to match a city from states.json
+CITY_FUZZY_CUTOFF = float(os.getenv("CITY_FUZZY_CUTOFF", "0.85"))
+# Most characters a fuzzy match may differ by, so it stays a typo and not another town
+CITY_FUZZY_MAX_EDITS = int(os.getenv("CITY_FUZZY_MAX_EDITS", "2"))
+# Refresh jobs re-fetch details of companies not refreshed for this many days
+REFRESH_MAX_AGE_DAYS = int(os.getenv("REFRESH_MAX_AGE_DAYS", "30"))
+# Stale companies loaded and saved per batch by a refresh job
+REFRESH_BATCH_SIZE = int(os.getenv("REFRESH_BATCH_SIZE", "200"))
 GOOGLE_CREDS_FILE = os.getenv("GOOGLE_CREDS_FILE")
 if not API_KEY:
     raise RuntimeError("Set the GOOGLE_API_KEY environment variable first.")
@@ -37,51 +70,496 @@ if not GOOGLE_CREDS_FILE:
 with open('states.json', 'r', encoding='utf-8') as file:
     LOCATIONS = json.load(file)
 
-# search func with Places API (New)
-def search_places(api_key, keyword, latitude, longitude, page_token=None, rad:int=LARGE_RADIUS_METERS):
-    url = "https://places.googleapis.com/v1/places:searchText"
+CITY_NAME_ABBREVIATIONS = {"saint": "st", "sainte": "ste", "fort": "ft", "mount": "mt"}
+# Leading words that tell neighbouring towns apart (East/West Hartford), never fuzzy-matched
+CITY_PREFIX_WORDS = {"north", "south", "east", "west", "new", "old", "upper", "lower", "port", "lake",
+                     "st", "ste", "ft", "mt"}
+
+def normalize_city_name(name: str) -> str:
+    """Lowercase ASCII form of a city name, e.g. 'Saint Paul ' -> 'st paul'."""
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii").lower()
+    words = re.sub(r"[^a-z0-9]+", " ", name).split()
+    return " ".join(CITY_NAME_ABBREVIATIONS.get(word, word) for word in words)
+
+# state code -> normalized city name -> (city type, city data)
+CITY_INDEX: dict[str, dict[str, tuple[str, dict]]] = {}
+for _state_code, _state_data in LOCATIONS.items():
+    for _city_type in ("large", "medium", "small"):
+        for _city_data in _state_data.get(_city_type, []):
+            CITY_INDEX.setdefault(_state_code, {})[normalize_city_name(_city_data["city"])] = (_city_type, _city_data)
+
+def find_city(city_name: str, state_code: str) -> Optional[tuple[str, dict]]:
+    """Look a city up in LOCATIONS by normalized, then fuzzy-matched name."""
+    cities = CITY_INDEX.get(state_code, {})
+    key = normalize_city_name(city_name)
+    if key in cities:
+        return cities[key]
+    for match in difflib.get_close_matches(key, cities.keys(), n=3, cutoff=CITY_FUZZY_CUTOFF):
+        if _is_typo_of(key, match):
+            return cities[match]
+    return None
+
+def _is_typo_of(typed: str, listed: str) -> bool:
+    """Whether two different normalized names are the same city with a typo."""
+    typed_first, listed_first = typed.split(" ", 1)[0], listed.split(" ", 1)[0]
+    if typed_first != listed_first and (typed_first in CITY_PREFIX_WORDS or listed_first in CITY_PREFIX_WORDS):
+        return False
+    return _edit_distance(typed, listed) <= CITY_FUZZY_MAX_EDITS
+
+def _edit_distance(a: str, b: str) -> int:
+    """Levenshtein distance between two strings."""
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+SEARCH_FIELD_MASK = "places.displayName,places.formattedAddress,places.id,places.location,nextPageToken"
+SINGLE_CALL_FIELD_MASK = SEARCH_FIELD_MASK + ",places.internationalPhoneNumber,places.websiteUri,places.rating"
+DETAILS_FIELD_MASK = "displayName,formattedAddress,internationalPhoneNumber,websiteUri,rating,location"
+# Counters that stand for real HTTP requests, the rest (cache hits etc.) are informational
+HTTP_CALL_COUNTERS = ("searchText", "details", "geocode", "retries")
+
+class RunStats(metrics.Metrics):
+    """Counters and latencies of one job run, also recorded process-wide."""
+    def __init__(self):
+        super().__init__(parent=metrics.registry)
+
+    def summary(self) -> str:
+        counts = self.snapshot()
+        parts = [f"{name}={count}" for name, count in sorted(counts.items())]
+        parts.append(f"total={sum(counts.get(name, 0) for name in HTTP_CALL_COUNTERS)}")
+        return ", ".join(parts)
+
+def _meters_to_degrees(lat: float, meters: float) -> tuple[float, float]:
+    """(latitude, longitude) degrees spanned by a distance at a latitude."""
+    return meters / METERS_PER_DEGREE, meters / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+
+def _search_request(api_key, keyword, latitude, longitude, page_token, rad, single_call, rectangle=False) -> tuple[str, str, dict, dict]:
+    """(cache key, url, headers, body) of a searchText call, shared with async_collector.
+
+    Without rectangle the search is biased to a circle of radius rad and may
+    return places from around it; with rectangle it is restricted to the square
+    of half-side rad, so a full result set means the square is really dense.
+    """
+    field_mask = SINGLE_CALL_FIELD_MASK if single_call else SEARCH_FIELD_MASK
+    cache_key = cache.make_key(
+        "searchText",
+        keyword=keyword,
+        lat=round(latitude, 6),
+        lng=round(longitude, 6),
+        radius=rad,
+        page_token=page_token,
+        field_mask=field_mask,
+        # Circle keys stay as they were before rectangles existed
+        **({"shape": "rectangle"} if rectangle else {}),
+    )
     headers = {
         "Content-Type": "application/json",
         "X-Goog-Api-Key": api_key,
-        "X-Goog-FieldMask": "places.displayName,places.formattedAddress,places.id,places.location,nextPageToken"
+        "X-Goog-FieldMask": field_mask
     }
-    data = {
-        "textQuery": keyword,
-        "locationBias": {
-            "circle": {
-                "center": {
-                    "latitude": latitude,
-                    "longitude": longitude
-                },
-                "radius": rad
+    if rectangle:
+        d_lat, d_lng = _meters_to_degrees(latitude, rad)
+        # searchText accepts no other restriction shape
+        location = {
+            "locationRestriction": {
+                "rectangle": {
+                    "low": {"latitude": latitude - d_lat, "longitude": longitude - d_lng},
+                    "high": {"latitude": latitude + d_lat, "longitude": longitude + d_lng}
+                }
             }
         }
-    }
+    else:
+        location = {
+            "locationBias": {
+                "circle": {
+                    "center": {
+                        "latitude": latitude,
+                        "longitude": longitude
+                    },
+                    "radius": rad
+                }
+            }
+        }
+    data = {"textQuery": keyword, **location}
     if page_token:
         data["pageToken"] = page_token
+    return cache_key, f"{PLACES_API_URL}/places:searchText", headers, data
+
+def _details_request(api_key, place_id) -> tuple[str, str, dict]:
+    """(cache key, url, headers) of a place details call."""
+    cache_key = cache.make_key("details", place_id=place_id, field_mask=DETAILS_FIELD_MASK)
+    headers = {
+        "Content-Type": "application/json",
+        "X-Goog-Api-Key": api_key,
+        "X-Goog-FieldMask": DETAILS_FIELD_MASK
+    }
+    return cache_key, f"{PLACES_API_URL}/places/{place_id}", headers
+
+# search func with Places API (New)
+def search_places(api_key, keyword, latitude, longitude, page_token=None, rad:int=LARGE_RADIUS_METERS, single_call: bool=False, stats: Optional[RunStats]=None, force_refresh: bool=False, rectangle: bool=False, cache_writes: Optional[list]=None):
+    cache_key, url, headers, data = _search_request(api_key, keyword, latitude, longitude, page_token, rad, single_call, rectangle)
+    if not force_refresh:
+        cached = cache.get("searchText", cache_key, stats)
+        if cached is not None:
+            return cached
     
-    response = requests.post(url, headers=headers, json=data)
+    metrics.incr("searchText", stats=stats)
+    try:
+        response = http_client.post(url, headers=headers, json=data, stats=stats, limiter=http_client.places_limiter, metric="searchText")
+    except requests.RequestException as e:
+        return f"Error: {str(e)}"
     
     if response.status_code == 200:
-        return response.json()
+        result = response.json()
+        cache.put("searchText", cache_key, result, cache_writes)
+        return result
     else:
         return f"Error: {response.status_code} - {response.text}"
 
-def get_place_details(api_key, place_id):
-    url = f"https://places.googleapis.com/v1/places/{place_id}"
-    headers = {
-        "Content-Type": "application/json",
-        "X-Goog-Api-Key": api_key,
-        "X-Goog-FieldMask": "displayName,formattedAddress,internationalPhoneNumber,websiteUri,rating,location"
-    }
+def get_place_details(api_key, place_id, stats: Optional[RunStats]=None, force_refresh: bool=False, cache_writes: Optional[list]=None):
+    cache_key, url, headers = _details_request(api_key, place_id)
+    if not force_refresh:
+        cached = cache.get("details", cache_key, stats)
+        if cached is not None:
+            return cached
     
-    response = requests.get(url, headers=headers)
+    metrics.incr("details", stats=stats)
+    try:
+        response = http_client.get(url, headers=headers, stats=stats, limiter=http_client.places_limiter, metric="details")
+    except requests.RequestException as e:
+        return f"Error: {str(e)}"
     
     if response.status_code == 200:
-        return response.json()
+        result = response.json()
+        cache.put("details", cache_key, result, cache_writes)
+        return result
     else:
         return f"Error: {response.status_code} - {response.text}"
 
+# Fields that only the details endpoint returns with the default search field mask
+DETAIL_FIELDS = ("internationalPhoneNumber", "websiteUri", "rating")
+
+_details_executor: Optional[ThreadPoolExecutor] = None
+_details_executor_lock = threading.Lock()
+
+def _get_details_executor() -> ThreadPoolExecutor:
+    global _details_executor
+    with _details_executor_lock:
+        if _details_executor is None:
+            _details_executor = ThreadPoolExecutor(max_workers=DETAILS_WORKERS, thread_name_prefix="details")
+        return _details_executor
+
+def _fetch_details(place: dict, stats: Optional[RunStats]=None, force_refresh: bool=False, cache_writes: Optional[list]=None):
+    # Search results that already carry every detail field need no extra call
+    if all(field in place for field in DETAIL_FIELDS):
+        return place
+    return get_place_details(API_KEY, place["id"], stats=stats, force_refresh=force_refresh, cache_writes=cache_writes)
+
+_inflight_lock = threading.Lock()
+
+def fetch_details_for_page(places: list[dict], stats: Optional[RunStats]=None, force_refresh: bool=False, inflight: Optional[dict]=None, cache_writes: Optional[list]=None) -> list:
+    """Fetch details for a page of places concurrently, results in page order.
+
+    inflight maps place_id to a pending or finished fetch and is shared by all
+    units of a run, so a place found by several keywords at once is fetched once.
+    Fetched responses are collected in cache_writes when given, see cache.put.
+    """
+    fetch = partial(_fetch_details, stats=stats, force_refresh=force_refresh, cache_writes=cache_writes)
+    if inflight is None:
+        if len(places) <= 1 or DETAILS_WORKERS <= 1:
+            return [fetch(place) for place in places]
+        return list(_get_details_executor().map(fetch, places))
+    futures = []
+    with _inflight_lock:
+        for place in places:
+            future = inflight.get(place["id"])
+            if future is None:
+                future = inflight[place["id"]] = _get_details_executor().submit(fetch, place)
+            futures.append(future)
+    return [future.result() for future in futures]
+
+def _radius_for(city_type: Optional[str]) -> int:
+    if city_type == "medium":
+        return MEDIUM_RADIUS_METERS
+    if city_type == "small":
+        return SMALL_RADIUS_METERS
+    return LARGE_RADIUS_METERS
+
+def _split_tile(lat: float, lng: float, size: float) -> list[tuple[float, float, float]]:
+    """Four quadrant tiles covering a tile, each with half the half-side.
+
+    size is the radius of a top-level circle or the half-side of a square
+    tile; the quadrants of a circle cover its bounding square.
+    """
+    half = size / 2
+    d_lat, d_lng = _meters_to_degrees(lat, half)
+    return [
+        (lat + d_lat, lng - d_lng, half),
+        (lat + d_lat, lng + d_lng, half),
+        (lat - d_lat, lng - d_lng, half),
+        (lat - d_lat, lng + d_lng, half),
+    ]
+
+# Fields whose changes are recorded in Company.updated_at as their 1-based positions
+TRACKED_FIELDS = ["phone", "website", "rating"]
+
+def _changed_fields(company: Company, data: dict) -> list[int]:
+    return [idx for idx, field in enumerate(TRACKED_FIELDS, start=1) if getattr(company, field) != data[field]]
+
+def save_companies(db: Session, rows: list[dict], job_run_id: Optional[int]=None, linked_place_ids=(), stats: Optional[RunStats]=None, unit_key: Optional[str]=None, cache_writes: Optional[list]=None) -> bool:
+    """Upsert a batch of companies and their job links with a single commit.
+
+    New place_ids are inserted, known ones get their tracked fields updated
+    with the change recorded in updated_at; both get refreshed_at set.
+    Rows of known place_ids only need place_id and TRACKED_FIELDS. linked_place_ids are already
+    stored companies that only need linking to the job run. With unit_key the
+    links are also recorded per unit for checkpoints.reuse. API responses
+    collected in cache_writes are cached in the same commit and the list is
+    emptied. Returns False if the batch was rolled back.
+    """
+    now_iso = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    place_ids = [row["place_id"] for row in rows]
+    current = {company.place_id: company for company in db.query(Company).filter(Company.place_id.in_(place_ids))}
+    inserts = []
+    updates = []
+    for row in rows:
+        company = current.get(row["place_id"])
+        if company is None:
+            inserts.append({**row, "fetched_at": now_iso, "updated_at": None, "refreshed_at": now_iso})
+            continue
+        updated_fields = _changed_fields(company, row)
+        if updated_fields:
+            updates.append({
+                "id": company.id,
+                **{field: row[field] for field in TRACKED_FIELDS},
+                "updated_at": json.dumps([updated_fields, now_iso]),
+                "refreshed_at": now_iso,
+            })
+        else:
+            updates.append({"id": company.id, "refreshed_at": now_iso})
+    try:
+        started = time.perf_counter()
+        if inserts:
+            # A place inserted meanwhile by another city worker keeps its row
+            db.execute(insert_for(Company).values(inserts).on_conflict_do_nothing(index_elements=["place_id"]))
+        if updates:
+            db.execute(update(Company), updates)
+        if job_run_id:
+            found = Company.place_id.in_(place_ids + list(linked_place_ids))
+            db.execute(
+                insert_for(JobRunCompany)
+                .from_select(["job_run_id", "company_id"], select(literal(job_run_id), Company.id).where(found))
+                .on_conflict_do_nothing(index_elements=["job_run_id", "company_id"])
+            )
+            if unit_key:
+                db.execute(
+                    insert_for(JobUnitCompany)
+                    .from_select(["job_run_id", "unit_key", "company_id"], select(literal(job_run_id), literal(unit_key), Company.id).where(found))
+                    .on_conflict_do_nothing(index_elements=["job_run_id", "unit_key", "company_id"])
+                )
+        if cache_writes:
+            cache.write(db, cache_writes)
+        db.commit()
+        if cache_writes:
+            cache.written(len(cache_writes))
+            cache_writes.clear()
+        metrics.observe("db_save", time.perf_counter() - started, stats)
+        metrics.incr("rows_saved", len(inserts) + len(updates), stats)
+        return True
+    except Exception as e:
+        logger.error(f"Error saving {len(rows)} companies: {str(e)}")
+        db.rollback()
+        return False
+
+def _new_places(places: list[dict], seen: set[str], existing: set[str], single_call: bool) -> list[dict]:
+    """Places of a page that are neither stored nor repeated, in page order."""
+    new_places = []
+    page_ids = set()
+    for place in places:
+        pid = place["id"]
+        if pid in seen or pid in existing or pid in page_ids:
+            continue
+        page_ids.add(pid)
+        if single_call:
+            # The search mask already asked for these; a missing key means no value
+            for field in DETAIL_FIELDS:
+                place.setdefault(field, None)
+        new_places.append(place)
+    return new_places
+
+def _company_rows(
+    new_places: list[dict],
+    details_results: list,
+    keyword: str,
+    state: Optional[str],
+    city: Optional[str],
+    city_type: Optional[str],
+    details_inflight: Optional[dict],
+) -> list[dict]:
+    rows = []
+    for place, details in zip(new_places, details_results):
+        pid = place["id"]
+        if isinstance(details, str):
+            logger.error(f"Error getting details place_id {pid}: {details}")
+            if details_inflight is not None:
+                # Let a later unit try again
+                with _inflight_lock:
+                    details_inflight.pop(pid, None)
+            continue
+        
+        rows.append({
+            "place_id": pid,
+            "name": place.get("displayName", {}).get("text"),
+            "address": place.get("formattedAddress"),
+            "phone": details.get("internationalPhoneNumber"),
+            "website": details.get("websiteUri"),
+            "rating": details.get("rating"),
+            "lat": place.get("location", {}).get("latitude"),
+            "lng": place.get("location", {}).get("longitude"),
+            "keyword": keyword,
+            "state": state,
+            "city": city,
+            "city_type": city_type,
+        })
+    return rows
+
+def _mark_stored(rows: list[dict], linked: set[str], seen: set[str], details_inflight: Optional[dict]):
+    seen.update(row["place_id"] for row in rows)
+    seen.update(linked)
+    if details_inflight is not None:
+        # Stored now, later pages find these through the existence check
+        with _inflight_lock:
+            for row in rows:
+                details_inflight.pop(row["place_id"], None)
+
+def _store_places(
+    db: Session,
+    places: list[dict],
+    keyword: str,
+    state: Optional[str],
+    job_run_id: Optional[int],
+    single_call: bool,
+    stats: Optional[RunStats],
+    force_refresh: bool,
+    seen: set[str],
+    city: Optional[str]=None,
+    city_type: Optional[str]=None,
+    unit_key: Optional[str]=None,
+    details_inflight: Optional[dict]=None,
+    cache_writes: Optional[list]=None,
+):
+    # The page's API responses are cached with its companies, or on their own if none are saved
+    try:
+        candidates = {place["id"] for place in places} - seen
+        if not candidates:
+            return
+        # One indexed lookup per page instead of loading every stored place_id
+        existing = {row[0] for row in db.query(Company.place_id).filter(Company.place_id.in_(candidates))}
+        # Ends the read so the connection goes back to the pool while details are fetched
+        db.rollback()
+        new_places = _new_places(places, seen, existing, single_call)
+        details_results = fetch_details_for_page(new_places, stats, force_refresh, details_inflight, cache_writes)
+        rows = _company_rows(new_places, details_results, keyword, state, city, city_type, details_inflight)
+        # Known places are not fetched again but still belong to this run's results
+        linked = existing if job_run_id else set()
+        if (rows or linked) and save_companies(db, rows, job_run_id, linked, stats, unit_key, cache_writes):
+            _mark_stored(rows, linked, seen, details_inflight)
+    finally:
+        if cache_writes:
+            cache.flush(cache_writes)
+
+def _location_steps(
+    keyword: str,
+    lat: float,
+    lng: float,
+    city_type: Optional[str],
+    single_call: bool,
+    force_refresh: bool,
+    adaptive_grid: bool,
+    tile_memo: Optional[dict],
+    checkpointed: bool,
+    resumed: Optional[dict],
+    stats: Optional[RunStats],
+):
+    """The searches of one location as a sequence of I/O steps.
+
+    Yields ("search", args, kwargs) for search_places and expects its result back,
+    ("store", places) and ("checkpoint", tiles, page_token, tile_results)
+    for checkpoints.save. The tile, page, memo and restart logic lives here
+    only; _collect_one_location and async_collector just perform the steps.
+    """
+    # (lat, lng, size, depth): a circle of radius size at depth 0, below that a square
+    # of half-side size; without adaptive_grid this stays one circle per city
+    tiles = [(lat, lng, _radius_for(city_type), 0)]
+    page_token = None
+    # Results of the first tile's pages fetched before a restart
+    tile_results = 0
+    if resumed:
+        tiles = [tuple(tile) for tile in resumed["tiles"]]
+        page_token = resumed["page_token"]
+        tile_results = resumed["tile_results"]
+    elif checkpointed:
+        # Claims the unit, other jobs wait for it instead of searching it too
+        yield ("checkpoint", tiles, None, 0)
+
+    while tiles:
+        tile_lat, tile_lng, size, depth = tiles.pop(0)
+        memo_key = (keyword, round(tile_lat, 5), round(tile_lng, 5), size, single_call)
+        if tile_memo is not None and memo_key in tile_memo and not page_token:
+            tile_places = tile_memo[memo_key]
+            yield ("store", tile_places)
+        else:
+            tile_places = []
+            # Only a tile searched from its first page is complete enough to memoize
+            from_first_page = not page_token
+            # Set when the tile starts over: its cached pages would hand back the same stale tokens
+            refetch = False
+            while True:
+                response = yield ("search", (tile_lat, tile_lng, page_token, size), {"force_refresh": force_refresh or refetch, "rectangle": depth > 0})
+                if isinstance(response, str):
+                    if page_token and not refetch:
+                        # Page tokens expire: a saved one, or one replayed by a cached earlier
+                        # page whose next page was never cached. Start the tile over once from fresh pages
+                        logger.warning(f"Page token for ({tile_lat}, {tile_lng}) rejected, restarting the tile: {response}")
+                        page_token, tile_results = None, 0
+                        tile_places = []
+                        from_first_page = True
+                        refetch = True
+                        continue
+                    logger.error(f"Error searching ({tile_lat}, {tile_lng}): {response}")
+                    break
+
+                places = response.get("places", [])
+                tile_places.extend(places)
+                yield ("store", places)
+
+                page_token = response.get("nextPageToken")
+                if not page_token:
+                    break
+                if checkpointed:
+                    yield ("checkpoint", [(tile_lat, tile_lng, size, depth)] + tiles, page_token, tile_results + len(tile_places))
+            if tile_memo is not None and from_first_page:
+                tile_memo[memo_key] = tile_places
+        page_token = None
+        found = tile_results + len(tile_places)
+        tile_results = 0
+
+        # A tile that hit the API's result cap probably hides more places
+        if (
+            adaptive_grid
+            and found >= GRID_FULL_RESULTS
+            and depth < GRID_MAX_DEPTH
+            and size / 2 >= GRID_MIN_RADIUS_METERS
+        ):
+            tiles.extend((sub_lat, sub_lng, sub_size, depth + 1) for sub_lat, sub_lng, sub_size in _split_tile(tile_lat, tile_lng, size))
+            metrics.incr("tiles_split", stats=stats)
+        if checkpointed and tiles:
+            yield ("checkpoint", tiles, None, 0)
+
 def _collect_one_location(
     db: Session,
     keyword: str,
@@ -90,240 +568,510 @@ def _collect_one_location(
     state: Optional[str]=None,
     job_run_id: Optional[int]=None,
     city_type: Optional[str]=None,
+    mode: str=COLLECT_MODE,
+    stats: Optional[RunStats]=None,
+    force_refresh: bool=False,
+    adaptive_grid: bool=ADAPTIVE_GRID,
+    tile_memo: Optional[dict]=None,
+    city: Optional[str]=None,
+    checkpoint_key: Optional[str]=None,
+    details_inflight: Optional[dict]=None,
 ):
-    existing = {row[0] for row in db.query(Company.place_id).yield_per(500)}
+    single_call = mode == "single"
+    city = normalize_city_name(city) if city else None
     seen: set[str] = set()
-    grid_points = [(lat, lng)]
+    checkpointed = job_run_id is not None and checkpoint_key is not None
+    resumed = checkpoints.load(job_run_id, checkpoint_key) if checkpointed else None
+    steps = _location_steps(keyword, lat, lng, city_type, single_call, force_refresh, adaptive_grid, tile_memo, checkpointed, resumed, stats)
+    # Responses of the current page, cached in one write when the page is stored
+    cache_writes: list[dict] = []
+    result = None
+    while True:
+        try:
+            step = steps.send(result)
+        except StopIteration:
+            break
+        result = None
+        if step[0] == "search":
+            result = search_places(API_KEY, keyword, *step[1], single_call=single_call, stats=stats, cache_writes=cache_writes, **step[2])
+        elif step[0] == "store":
+            _store_places(db, step[1], keyword, state, job_run_id, single_call, stats, force_refresh, seen, city, city_type, checkpoint_key, details_inflight, cache_writes)
+        else:
+            checkpoints.save(job_run_id, checkpoint_key, *step[1:])
 
-    for grid_lat, grid_lng in grid_points:
-        page_token = None
-        while True:
-            response = search_places(
-                API_KEY, keyword,
-                grid_lat,
-                grid_lng,
-                page_token,
-                LARGE_RADIUS_METERS if city_type == "large" else MEDIUM_RADIUS_METERS if city_type == "medium" else SMALL_RADIUS_METERS if city_type == "small" else LARGE_RADIUS_METERS
-                )
-            if isinstance(response, str):
-                logger.error(f"Error searching ({grid_lat}, {grid_lng}): {response}")
-                break
-            
-            for place in response.get("places", []):
-                pid = place["id"]
-                if pid in seen or pid in existing:
-                    continue
-                
-                details = get_place_details(API_KEY, pid)
-                if isinstance(details, str):
-                    logger.error(f"Error getting details place_id {pid}: {details}")
-                    continue
-                
-                company_data = {
-                    "name": place.get("displayName", {}).get("text"),
-                    "address": place.get("formattedAddress"),
-                    "phone": details.get("internationalPhoneNumber"),
-                    "website": details.get("websiteUri"),
-                    "rating": details.get("rating"),
-                    "lat": place.get("location", {}).get("latitude"),
-                    "lng": place.get("location", {}).get("longitude"),
-                    "keyword": keyword,
-                    "state": state,
-                }
-                
-                company = db.query(Company).filter_by(place_id=pid).first()
-                now_iso = datetime.now(timezone.utc).isoformat(timespec="seconds")
-                if company:
-                    updated_fields = []
-                    for idx, field in enumerate(["phone", "website", "rating"], start=1):
-                        if getattr(company, field) != company_data[field]:
-                            setattr(company, field, company_data[field])
-                            updated_fields.append(idx)
-                    if updated_fields:
-                        company.updated_at = json.dumps([updated_fields, now_iso])
-                        db.add(company)
-                else:
-                    company = Company(
-                        place_id=pid,
-                        fetched_at=now_iso,
-                        updated_at=None,
-                        **company_data
-                    )
-                    db.add(company)
-                    db.commit()
-                
-                if job_run_id:
-                    existing_link = db.query(JobRunCompany).filter_by(job_run_id=job_run_id, company_id=company.id).first()
-                    if not existing_link:
-                        link = JobRunCompany(job_run_id=job_run_id, company_id=company.id)
-                        db.add(link)
-                        db.commit()
-                
-                seen.add(pid)
-                try:
-                    db.commit()
-                except Exception as e:
-                    logger.error(f"Error saving data for place_id {pid}: {str(e)}")
-                    db.rollback()
-            
-            page_token = response.get("nextPageToken")
-            if not page_token:
-                break
-            time.sleep(REQUEST_DELAY)
-
-def geocode_city(city_name, state_code):
-    url = "https://maps.googleapis.com/maps/api/geocode/json"
-    params = {
+    if checkpointed:
+        checkpoints.mark_done(job_run_id, checkpoint_key)
+
+def _geocode_params(city_name, state_code) -> dict:
+    return {
         "address": f"{city_name}, {state_code}, USA",
         "key": API_KEY
     }
-    try:
-        resp = requests.get(url, params=params)
-        if resp.status_code == 200:
-            data = resp.json()
-            if data["status"] == "OK" and data["results"] != None:
-                loc = data["results"][0]["geometry"]["location"]
-                return loc["lat"], loc["lng"]
-            else:
-                raise RuntimeError(
-                    f"City '{city_name}' not found in state '{state_code}'. Geocoding status: {data.get('status')}, results: {data.get('results')}")
+
+def _geocode_location(resp, city_name, state_code) -> tuple[float, float]:
+    """Coordinates from a requests or httpx geocoding response."""
+    if resp.status_code == 200:
+        data = resp.json()
+        if data["status"] == "OK" and data["results"] != None:
+            loc = data["results"][0]["geometry"]["location"]
+            return loc["lat"], loc["lng"]
         else:
-            raise RuntimeError(f"Geocoding request failed with status code {resp.status_code}: {resp.text}")
+            raise RuntimeError(
+                f"City '{city_name}' not found in state '{state_code}'. Geocoding status: {data.get('status')}, results: {data.get('results')}")
+    else:
+        raise RuntimeError(f"Geocoding request failed with status code {resp.status_code}: {resp.text}")
+
+def geocode_city(city_name, state_code, stats: Optional[RunStats]=None):
+    metrics.incr("geocode", stats=stats)
+    try:
+        resp = http_client.get(GEOCODE_API_URL, params=_geocode_params(city_name, state_code), stats=stats, limiter=http_client.geocode_limiter, metric="geocode")
+        return _geocode_location(resp, city_name, state_code)
     except requests.RequestException as e:
         raise RuntimeError(f"Failed to geocode city '{city_name}': {str(e)}")
 
+def city_key(city_name: str, state_code: Optional[str]) -> str:
+    """Value stored in Company.city for a city typed by a user."""
+    found = find_city(city_name, state_code) if state_code else None
+    return normalize_city_name(found[1]["city"] if found else city_name)
 
-def collect_companies(
+def resolve_city(city_name: str, state_code: str, stats: Optional[RunStats]=None) -> tuple[float, float]:
+    """Coordinates of a typed city: states.json first, then the geocode cache, then the API."""
+    found = find_city(city_name, state_code)
+    if found:
+        _, city_data = found
+        return city_data["lat"], city_data["lng"]
+    cache_key = cache.make_key("geocode", city=normalize_city_name(city_name), state=state_code)
+    cached = cache.get("geocode", cache_key, stats)
+    if cached is not None:
+        return cached["lat"], cached["lng"]
+    lat, lng = geocode_city(city_name, state_code, stats=stats)
+    cache.put("geocode", cache_key, {"lat": lat, "lng": lng})
+    return lat, lng
+
+
+def _collect_city_isolated(
     keyword: str,
-    states: Optional[str] = None,
+    state_code: str,
+    city_type: str,
+    city_data: dict,
+    key: str,
+    task_id: Optional[str],
+    job_run_id: Optional[int],
+    db: Optional[Session] = None,
+    **options,
+) -> bool:
+    """Collect one city, in its own session unless db is given; errors are logged, not raised."""
+    own_session = db is None
+    if own_session:
+        db = SessionLocal()
+    try:
+        log_status(task_id, f"Collecting '{keyword}' for {city_data['city']}, {state_code} ({city_type or 'manual'})")
+        _collect_one_location(
+            db,
+            keyword,
+            city_data['lat'],
+            city_data['lng'],
+            state_code,
+            job_run_id,
+            city_type=city_type,
+            city=city_data['city'],
+            checkpoint_key=key,
+            **options,
+        )
+        return True
+    except Exception as e:
+        db.rollback()
+        log_status(task_id, f"Error collecting for {city_data['city']}, {state_code}: {str(e)}")
+        return False
+    finally:
+        if own_session:
+            db.close()
+
+
+def _collect_units(
+    db: Session,
+    units: list[tuple[str, str, Optional[str], dict, str]],
+    task_id: Optional[str],
+    job_run_id: Optional[int],
+    workers: int,
+    options: dict,
+):
+    """Collect (keyword, state, city_type, city_data, unit_key) units, in parallel when workers > 1.
+
+    A failing city is logged and skipped either way, the other cities still run.
+    """
+    if workers <= 1 or len(units) <= 1:
+        results = [
+            _collect_city_isolated(keyword, state_code, current_type, city_data, key, task_id, job_run_id, db=db, **options)
+            for keyword, state_code, current_type, city_data, key in units
+        ]
+    else:
+        # Sessions are not thread-safe, so every city gets its own one
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="city") as executor:
+            futures = [
+                executor.submit(
+                    _collect_city_isolated,
+                    keyword,
+                    state_code,
+                    current_type,
+                    city_data,
+                    key,
+                    task_id,
+                    job_run_id,
+                    **options,
+                )
+                for keyword, state_code, current_type, city_data, key in units
+            ]
+            results = [future.result() for future in as_completed(futures)]
+    failed = results.count(False)
+    if failed:
+        log_status(task_id, f"{failed} of {len(units)} cities failed, see errors above")
+
+def _collect_options(keyword: str | list[str], mode: Optional[str], stats: RunStats, force_refresh: bool, adaptive_grid: Optional[bool]) -> tuple[list[str], dict]:
+    """Validated keywords and the options passed down to every unit of a job."""
+    mode = mode or COLLECT_MODE
+    if mode not in ("single", "two_step"):
+        raise ValueError(f"Unknown collect mode '{mode}', expected 'single' or 'two_step'.")
+    keywords = [keyword] if isinstance(keyword, str) else list(dict.fromkeys(k.strip() for k in keyword if k.strip()))
+    if not keywords:
+        raise ValueError("At least one keyword is required.")
+    options = {
+        "mode": mode,
+        "stats": stats,
+        "force_refresh": force_refresh,
+        "adaptive_grid": ADAPTIVE_GRID if adaptive_grid is None else adaptive_grid,
+        "tile_memo": {},
+        "details_inflight": {},
+    }
+    return keywords, options
+
+def _manual_units(keywords: list[str], state: str, city_name: str, lat: float, lng: float, adaptive_grid: bool) -> list:
+    city = city_key(city_name, state)
+    # Searched with the default radius and stored without a city_type
+    city_data = {"city": city, "lat": lat, "lng": lng}
+    return [
+        (kw, state, None, city_data, checkpoints.unit_key(kw, state, "manual", city, adaptive_grid))
+        for kw in keywords
+    ]
+
+def _location_units(keywords: list[str], states: Optional[str | list[str]], city_type: Optional[str], city_name: Optional[str], adaptive_grid: bool, task_id: Optional[str]) -> list:
+    """Units of every (keyword, city) pair of states.json the job asks for."""
+    state_codes = [states] if isinstance(states, str) or states is None else list(states)
+    if not state_codes or None in state_codes or "ALL" in state_codes:
+        locations = list(LOCATIONS.items())
+    else:
+        locations = []
+        for state_code in state_codes:
+            state_data = LOCATIONS.get(state_code)
+            if not state_data:
+                log_status(task_id, f"State '{state_code}' not found in LOCATIONS or has no cities.")
+                continue
+            locations.append((state_code, state_data))
+
+    units = []
+    for state_code, state_data in locations:
+        types_to_process = [city_type] if city_type and city_type != "all" else ['large', 'medium', 'small']
+        for current_type in types_to_process:
+            cities = state_data.get(current_type, [])
+            for city_data in cities:
+                if city_name and city_data['city'].lower() != city_name.lower():
+                    continue
+                # Keywords of one city run back to back, their places overlap the most
+                for kw in keywords:
+                    key = checkpoints.unit_key(kw, state_code, current_type, city_data['city'], adaptive_grid)
+                    units.append((kw, state_code, current_type, city_data, key))
+    return units
+
+def _plan_units(units: list, job_run_id: int, task_id: Optional[str], stats: RunStats, force_refresh: bool) -> tuple[list, list, dict[str, int]]:
+    """Split a job's units into (to collect, deferred, running).
+
+    Units the job finished before a restart are dropped, units other jobs
+    finished recently are linked right away; deferred units are being
+    collected by the job in running[unit_key] and are waited for after the
+    job's own work.
+    """
+    # A re-queued job skips the cities it finished before it was interrupted
+    done = checkpoints.completed_units(job_run_id)
+    if done:
+        remaining = [unit for unit in units if unit[4] not in done]
+        log_status(task_id, f"Resuming: {len(units) - len(remaining)} of {len(units)} cities already collected")
+        units = remaining
+
+    reusable, running = checkpoints.find_shared(job_run_id, [unit[4] for unit in units]) if not force_refresh else ({}, {})
+    for key, source_job_run_id in reusable.items():
+        checkpoints.reuse(job_run_id, key, source_job_run_id)
+        metrics.incr("units_reused", stats=stats)
+    deferred = [unit for unit in units if unit[4] in running]
+    units = [unit for unit in units if unit[4] not in reusable and unit[4] not in running]
+    # Claimed up front, so a job planned meanwhile waits for units this one has not reached yet
+    checkpoints.claim(job_run_id, [unit[4] for unit in units])
+    if reusable or deferred:
+        log_status(task_id, f"Planner: {len(reusable)} cities reused from recent jobs, {len(deferred)} in progress elsewhere, {len(units)} to collect")
+    return units, deferred, running
+
+def collect_companies(
+    keyword: str | list[str],
+    states: Optional[str | list[str]] = None,
     task_id: Optional[str] = None,
     city_type: Optional[str] = None,
     city_name: Optional[str] = None,
     job_run_id: Optional[int] = None,
-    db: Optional[Session] = None
+    db: Optional[Session] = None,
+    max_workers: Optional[int] = None,
+    mode: Optional[str] = None,
+    stats: Optional[RunStats] = None,
+    force_refresh: bool = False,
+    adaptive_grid: Optional[bool] = None,
 ):
+    """Collect companies for one keyword or a batch of keywords.
+
+    Every (keyword, city) pair becomes a unit of one shared run: units of all
+    keywords share the workers, the tile memo and the job's links, and a place
+    found by several keywords is stored and fetched once.
+    """
+    if stats is None:
+        stats = RunStats()
+    keywords, options = _collect_options(keyword, mode, stats, force_refresh, adaptive_grid)
     close_db = False
     if db is None:
         db = SessionLocal()
         close_db = True
     try:
         if city_type == "manual" and city_name and states:
+            if not isinstance(states, str):
+                raise ValueError("A manually entered city needs exactly one state.")
             try:
-                lat, lng = geocode_city(city_name, states)
+                lat, lng = resolve_city(city_name, states, stats=stats)
             except Exception as e:
                 log_status(task_id, f"Geocoding error: {str(e)}")
                 raise RuntimeError(f"Geocoding error: {str(e)}")
-            log_status(task_id, f"Collecting for {city_name}, {states} (manual)")
-            _collect_one_location(
-                db,
-                keyword,
-                lat,
-                lng,
-                states,
-                job_run_id,
-                city_type=None
-            )
-            return
-
-        if states is None or states == "ALL":
-            locations = LOCATIONS.items()
+            units = _manual_units(keywords, states, city_name, lat, lng, options["adaptive_grid"])
         else:
-            state_data = LOCATIONS.get(states)
-            if not state_data:
-                log_status(task_id, f"State '{states}' not found in LOCATIONS or has no cities.")
+            units = _location_units(keywords, states, city_type, city_name, options["adaptive_grid"], task_id)
+            if not units:
                 return
-            locations = [(states, state_data)]
-
-        for state_code, state_data in locations:
-            types_to_process = [city_type] if city_type and city_type != "all" else ['large', 'medium', 'small']
-            for current_type in types_to_process:
-                cities = state_data.get(current_type, [])
-                for city_data in cities:
-                    if city_name and city_data['city'].lower() != city_name.lower():
-                        continue
-                    log_status(task_id, f"Collecting for {city_data['city']}, {state_code} ({current_type})")
-                    _collect_one_location(
-                        db,
-                        keyword,
-                        city_data['lat'],
-                        city_data['lng'],
-                        state_code,
-                        job_run_id,
-                        city_type=current_type
-                    )
+
+        workers = max_workers if max_workers is not None else CITY_WORKERS
+        if job_run_id is None:
+            _collect_units(db, units, task_id, job_run_id, workers, options)
+            return
+
+        # Units other jobs finished recently are linked, not searched; units they are
+        # searching right now are waited for after this job's own work
+        units, deferred, running = _plan_units(units, job_run_id, task_id, stats, force_refresh)
+        _collect_units(db, units, task_id, job_run_id, workers, options)
+        for unit in deferred:
+            key = unit[4]
+            if checkpoints.wait_for(running[key], key):
+                checkpoints.reuse(job_run_id, key, running[key])
+                metrics.incr("units_reused", stats=stats)
+            else:
+                log_status(task_id, f"Job {running[key]} did not finish '{unit[0]}' for {unit[3]['city']}, {unit[1]}, collecting it here")
+                _collect_units(db, [unit], task_id, job_run_id, workers, options)
     except Exception as e:
         raise
     finally:
+        log_status(task_id, f"HTTP calls ({options['mode']} mode): {stats.summary()}")
         if close_db:
             db.close()
 
+def refresh_companies(
+    keyword: Optional[str] = None,
+    state: Optional[str] = None,
+    max_age_days: Optional[int] = None,
+    task_id: Optional[str] = None,
+    job_run_id: Optional[int] = None,
+    stats: Optional[RunStats] = None,
+) -> int:
+    """Re-fetch details of stored companies not refreshed for max_age_days.
+
+    Only the details endpoint is called, DETAILS_WORKERS at a time, and
+    changes go through save_companies so they are recorded in updated_at.
+    Refreshed companies are linked to job_run_id. Returns how many were
+    refreshed.
+    """
+    if stats is None:
+        stats = RunStats()
+    max_age_days = REFRESH_MAX_AGE_DAYS if max_age_days is None else max_age_days
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=max_age_days)).isoformat(timespec="seconds")
+    refreshed = 0
+    failed = 0
+    last_id = 0
+    with SessionLocal() as db:
+        query = db.query(Company.id, Company.place_id).filter(func.coalesce(Company.refreshed_at, Company.fetched_at) < cutoff)
+        if keyword:
+            query = query.filter(Company.keyword == keyword)
+        if state and state != "ALL":
+            query = query.filter(Company.state == state)
+        try:
+            while True:
+                # Keyset pagination, rows refreshed by the previous batch no longer match anyway
+                batch = query.filter(Company.id > last_id).order_by(Company.id).limit(REFRESH_BATCH_SIZE).all()
+                if not batch:
+                    break
+                last_id = batch[-1].id
+                places = [{"id": place_id} for _, place_id in batch]
+                rows = []
+                cache_writes: list[dict] = []
+                for place, details in zip(places, fetch_details_for_page(places, stats, force_refresh=True, cache_writes=cache_writes)):
+                    if isinstance(details, str):
+                        logger.error(f"Error refreshing place_id {place['id']}: {details}")
+                        failed += 1
+                        continue
+                    rows.append({
+                        "place_id": place["id"],
+                        "phone": details.get("internationalPhoneNumber"),
+                        "website": details.get("websiteUri"),
+                        "rating": details.get("rating"),
+                    })
+                if rows and save_companies(db, rows, job_run_id, stats=stats, cache_writes=cache_writes):
+                    refreshed += len(rows)
+                cache.flush(cache_writes)
+                log_status(task_id, f"Refreshed {refreshed} companies so far")
+        finally:
+            log_status(task_id, f"Refresh done: {refreshed} refreshed, {failed} failed, HTTP calls: {stats.summary()}")
+    return refreshed
+
+def backfill_company_cities():
+    """Fill city/city_type for companies stored before those columns existed.
+
+    Matches the same address substrings the export used to filter on; rows
+    that match no known city get an empty city so they are not rescanned.
+    """
+    with SessionLocal() as db:
+        if not db.query(Company.id).filter(Company.city.is_(None), Company.state.isnot(None)).first():
+            return
+        for state_code, cities in CITY_INDEX.items():
+            for key, (city_type, city_data) in cities.items():
+                db.execute(
+                    update(Company)
+                    .where(
+                        Company.state == state_code,
+                        Company.city.is_(None),
+                        Company.address.like(f"%{city_data['city']}%"),
+                    )
+                    .values(city=key, city_type=city_type)
+                    .execution_options(synchronize_session=False)
+                )
+        db.execute(
+            update(Company)
+            .where(Company.city.is_(None), Company.state.isnot(None))
+            .values(city="")
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+
 class CollectorTask:
-    def __init__(self, keyword: str, states: Optional[str]=None):
-        self.id = str(uuid.uuid4())
+    def __init__(self, keyword: str, states: Optional[str]=None, task_id: Optional[str]=None):
+        self.id = task_id or str(uuid.uuid4())
         self.keyword = keyword
         self.states = states
         self.status = "in progress"
+        # Live counters and latencies while the job runs
+        self.stats = RunStats()
+        self.job_run_id: Optional[int] = None
+
 
+_log_lock = threading.Lock()
 
 def log_status(task_id: str, message: str):
     logger.info(f"task_id {task_id}, {message}")
     log_file = f"logs\\{task_id}.log"
-    with open(log_file, "a", encoding="utf-8") as lf:
-        lf.write(message + "\n")
+    with _log_lock:
+        with open(log_file, "a", encoding="utf-8") as lf:
+            lf.write(message + "\n")
 
-active_threads = {}
+tasks: dict[str, CollectorTask] = {}
 
-def run_collector_in_thread(keyword: str, state: Optional[str]=None, city_type: Optional[str] = None, city_name: Optional[str] = None, user_id: Optional[str] = None):
-    task = CollectorTask(keyword, state)
-    log_status(task.id, f"Task {task.id} started at {datetime.now(timezone.utc).isoformat(timespec='seconds')}")
-    def target():
-        start_time = time.time()
-        db = SessionLocal()
-        try:
-            user = db.query(User).filter_by(user_id=user_id).first() if user_id else None
-            if not user:
-                raise ValueError(f"User with user_id={user_id} not found in database.")
-            job_run = JobRun(
-                user_email_id=user.id,
-                params=json.dumps({"keyword": keyword, "state": state, "city_type": city_type, "city_name": city_name}),
-                started_at=datetime.now(timezone.utc).isoformat(timespec="seconds"),
-                finished_at=None
-            )
-            db.add(job_run)
-            db.commit()
-            collect_companies(
-                keyword=keyword,
-                states=state,
-                task_id=task.id,
-                city_type=city_type,
-                city_name=city_name,
-                job_run_id=job_run.id,
-                db=db
-            )
-            job_run.finished_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
-            db.commit()
-            task.status = "done"
-        except Exception as e:
-            tb = traceback.format_exc()
-            log_status(task.id, f"Error occured: {str(e)}\n{tb}")
-            task.status = f"failed: {str(e)}"
-        finally:
-            elapsed = time.time() - start_time
-            log_status(task.id, f"Task {task.id} finished with status: {task.status} in {elapsed:.2f} seconds")
-            db.close()
-        active_threads.pop(task.id, None)
+def get_task(task_id: str) -> Optional[CollectorTask]:
+    return tasks.get(task_id)
 
-    thread = threading.Thread(target=target)
-    thread.start()
-    active_threads[task.id] = thread
-    return task.id
+def run_collector_in_thread(keyword: str | list[str], state: Optional[str | list[str]]=None, city_type: Optional[str] = None, city_name: Optional[str] = None, user_id: Optional[str] = None, mode: Optional[str] = None, force_refresh: bool = False, adaptive_grid: Optional[bool] = None, on_done: Optional[Callable[[CollectorTask], None]] = None, chat_id: Optional[int] = None):
+    """Queue a collection job; it runs on the job queue's worker pool.
+
+    A list of keywords (and/or states) queues one batch job with a single
+    combined export.
+    """
+    from jobqueue import job_queue
+    job_queue.start()
+    if isinstance(keyword, list):
+        keywords = list(dict.fromkeys(keyword))
+        batch = {"keywords": keywords, "keyword": ", ".join(keywords)}
+    else:
+        batch = {"keyword": keyword}
+    _, task_id = job_queue.submit(
+        user_id,
+        {**batch, "state": state, "city_type": city_type, "city_name": city_name, "mode": mode or COLLECT_MODE, "force_refresh": force_refresh, "adaptive_grid": adaptive_grid, "chat_id": chat_id},
+        on_done=on_done,
+    )
+    return task_id
+
+def run_refresh_in_thread(keyword: Optional[str]=None, state: Optional[str]=None, user_id: Optional[str] = None, max_age_days: Optional[int] = None, on_done: Optional[Callable[[CollectorTask], None]] = None, chat_id: Optional[int] = None):
+    """Queue a refresh job for stale companies, see refresh_companies."""
+    from jobqueue import job_queue
+    job_queue.start()
+    _, task_id = job_queue.submit(
+        user_id,
+        {"type": "refresh", "keyword": keyword, "state": state, "city_type": None, "city_name": None, "max_age_days": max_age_days, "chat_id": chat_id},
+        on_done=on_done,
+    )
+    return task_id
 
 def wait_for_task(task_id: str, timeout: Optional[float] = None):
-    thread = active_threads.get(task_id)
-    if thread is None:
-        return True  
-    thread.join(timeout)
-    return not thread.is_alive()
+    from jobqueue import job_queue
+    return job_queue.wait(task_id, timeout)
+
+SHEET_HEADERS = ["Place Id", "Name", "Address", "Phone", "Website", "Rating", "Lat", "Lng", "Keyword", "State", "Fetched At", "Updated At"]
+
+def _company_row(company: Company) -> list:
+    return [
+        company.place_id,
+        company.name,
+        company.address,
+        company.phone or "",
+        company.website or "",
+        company.rating or "",
+        company.lat,
+        company.lng,
+        company.keyword,
+        company.state,
+        company.fetched_at,
+        company.updated_at or ""
+    ]
+
+# ExportedPlace rows inserted per statement, well below SQLite's bound parameter limit
+_EXPORTED_INSERT_CHUNK = 500
+
+def _record_exported(spreadsheet_id: str, place_ids: list[str]):
+    if not place_ids:
+        return
+    with SessionLocal() as db:
+        for start in range(0, len(place_ids), _EXPORTED_INSERT_CHUNK):
+            db.execute(
+                insert_for(ExportedPlace)
+                .values([{"spreadsheet_id": spreadsheet_id, "place_id": place_id} for place_id in place_ids[start:start + _EXPORTED_INSERT_CHUNK]])
+                .on_conflict_do_nothing(index_elements=["spreadsheet_id", "place_id"])
+            )
+        db.commit()
+
+def _matching_companies_query(db: Session, keyword, state, city_type, city_name):
+    """Stored companies matching a search; keyword and state may also be lists (batch jobs)."""
+    query = db.query(Company)
+    if isinstance(keyword, list):
+        query = query.filter(Company.keyword.in_(keyword))
+    elif keyword:
+        query = query.filter(Company.keyword == keyword)
+    if isinstance(state, list):
+        if "ALL" not in state:
+            query = query.filter(Company.state.in_(state))
+    elif state and state != "ALL":
+        query = query.filter(Company.state == state)
+    # Served by the (keyword, state, city) and (keyword, city_type, state) indexes
+    if city_name:
+        query = query.filter(Company.city == city_key(city_name, state if state != "ALL" else None))
+    if city_type and city_type not in ("all", "manual"):
+        query = query.filter(Company.city_type == city_type)
+    return query
 
 def create_google_sheet(
         spreadsheet_id: str = None,
@@ -334,96 +1082,76 @@ def create_google_sheet(
         city_type: Optional[str] = None,
         city_name: Optional[str] = None,
         job_run_id: Optional[int] = None,
+        all_matches: bool = False,  # With a job_run_id, export every stored match instead of just that run
+        skip_exported: bool = True,  # On append, leave out places already written to this spreadsheet
 ) -> str:
-    creds = get_credentials()
-    service = build("sheets", "v4", credentials=creds, cache_discovery=False)
-    drive_service = build("drive", "v3", credentials=creds, cache_discovery=False)
+    service = get_service("sheets", "v4")
 
     if not spreadsheet_id:
         raise ValueError("spreadsheet_id must be provided to write to an existing Google Sheet.")
 
+    # place_ids of the chunks written so far
+    exported: list[str] = []
     db = SessionLocal()
     try:
-        query = db.query(Company)
-        if keyword:
-            query = query.filter(Company.keyword == keyword)
-        if state and state != "ALL":
-            query = query.filter(Company.state == state)
-        if city_name:
-            query = query.filter(Company.address.like(f"%{city_name}%"))
-        if city_type and city_type != "all":
-            if state and state != "ALL":
-                cities_in_state = LOCATIONS.get(state, {})
-                cities_of_type = cities_in_state.get(city_type, [])
-                city_names = [city['city'] for city in cities_of_type]
-                if city_names:
-                    query = query.filter(or_(*[Company.address.like(f"%{name}%") for name in city_names]))
-            else:
-                all_cities_of_type = []
-                for state_data in LOCATIONS.values():
-                    all_cities_of_type.extend(city['city'] for city in state_data.get(city_type, []))
-                if all_cities_of_type:
-                    query = query.filter(or_(*[Company.address.like(f"%{name}%") for name in all_cities_of_type]))
-        companies = query.all()
-    finally:
-        db.close()
-
-    # Prepare data for Google Sheets
-    headers = ["Place Id", "Name", "Address", "Phone", "Website", "Rating", "Lat", "Lng", "Keyword", "State", "Fetched At", "Updated At"]
-    values = [headers]
-
-    for company in companies:
-        values.append([
-            company.place_id,
-            company.name,
-            company.address,
-            company.phone or "",
-            company.website or "",
-            company.rating or "",
-            company.lat,
-            company.lng,
-            company.keyword,
-            company.state,
-            company.fetched_at,
-            company.updated_at or ""
-        ])
-
-    if task_state:
-        # Overwrite: clear and write from A1
-        service.spreadsheets().values().clear(
-            spreadsheetId=spreadsheet_id,
-            range="A1:Z10000"
-        ).execute()
-        service.spreadsheets().values().update(
-            spreadsheetId=spreadsheet_id,
-            range="A1",
-            valueInputOption="RAW",
-            body={"values": values}
-        ).execute()
-    else:
-        # Append: get current number of rows and append after them
-        sheet = service.spreadsheets().values().get(
-            spreadsheetId=spreadsheet_id,
-            range="A1:Z10000"
-        ).execute()
-        existing_rows = sheet.get("values", [])
-        start_row = len(existing_rows) + 1  
-        if not existing_rows:
-            append_values = values
+        if job_run_id and not all_matches:
+            # Exactly the companies linked to the run, via the (job_run_id, company_id) index
+            query = (
+                db.query(Company)
+                .join(JobRunCompany, JobRunCompany.company_id == Company.id)
+                .filter(JobRunCompany.job_run_id == job_run_id)
+                .order_by(JobRunCompany.id)
+            )
         else:
-            append_values = values[1:] 
-        if append_values:
-            service.spreadsheets().values().append(
+            query = _matching_companies_query(db, keyword, state, city_type, city_name).order_by(Company.id)
+        sheet = sheets.get_first_sheet(service, spreadsheet_id)
+        if task_state:
+            # Overwrite: clear the whole tab and write from A1
+            sheets.execute(service.spreadsheets().values().clear(
                 spreadsheetId=spreadsheet_id,
-                range=f"A{start_row}",
-                valueInputOption="RAW",
-                insertDataOption="INSERT_ROWS",
-                body={"values": append_values}
-            ).execute()
+                range=sheets.a1(sheet["title"]),
+                body={}
+            ))
+            with SessionLocal() as write_db:
+                write_db.execute(delete(ExportedPlace).where(ExportedPlace.spreadsheet_id == spreadsheet_id))
+                write_db.commit()
+            with_headers = True
+        else:
+            if skip_exported:
+                already_exported = select(ExportedPlace.id).where(
+                    ExportedPlace.spreadsheet_id == spreadsheet_id,
+                    ExportedPlace.place_id == Company.place_id,
+                )
+                query = query.filter(~already_exported.exists())
+            # Only an empty sheet needs headers; check a single cell instead of downloading the sheet
+            with_headers = not db.query(ExportedPlace.id).filter_by(spreadsheet_id=spreadsheet_id).first() and not sheets.execute(
+                service.spreadsheets().values().get(
+                    spreadsheetId=spreadsheet_id,
+                    range=sheets.a1(sheet["title"], "A1")
+                )
+            ).get("values")
+
+        rows = (_company_row(company) for company in query.yield_per(sheets.SHEETS_CHUNK_ROWS))
+        if with_headers:
+            rows = itertools.chain([SHEET_HEADERS], rows)
+        writer = sheets.ChunkedSheetWriter(
+            service,
+            spreadsheet_id,
+            sheet,
+            append=not task_state,
+            on_flush=lambda chunk: exported.extend(row[0] for row in chunk if row is not SHEET_HEADERS),
+        )
+        writer.write(rows)
+    finally:
+        db.close()
+        # Written once the read stream is closed: without WAL a write from another
+        # connection fails with "database is locked" while the stream is open.
+        # Chunks that made it to the sheet are recorded even if a later one failed.
+        _record_exported(spreadsheet_id, exported)
 
     # Share with user
     if user_email:
-        drive_service = build("drive", "v3", credentials=creds)
+        drive_service = get_service("drive", "v3")
         drive_service.permissions().create(
             fileId=spreadsheet_id,
             body={"type": "user", "role": "writer", "emailAddress": user_email},
@@ -434,8 +1162,7 @@ def create_google_sheet(
 
 
 def create_sheet_for_user(username: str):
-    creds = get_credentials()
-    service = build("sheets", "v4", credentials=creds, cache_discovery=False)
+    service = get_service("sheets", "v4")
     
     spreadsheet = {
         'properties': {
@@ -1,8 +1,12 @@
+import asyncio
+import json
+import metrics
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ContextTypes
-from parser import run_collector_in_thread, create_google_sheet, LOCATIONS, wait_for_task
+from telegram.ext import Application, ContextTypes
+from parser import run_collector_in_thread, run_refresh_in_thread, create_google_sheet, get_task, LOCATIONS, CollectorTask, REFRESH_MAX_AGE_DAYS
+from jobqueue import job_queue
 from userauth import get_user_email, set_user_email, is_valid_email
-from db import SessionLocal, User
+from db import SessionLocal, User, JobRun
 
 STATES_PER_PAGE = 10
 STATE_CODES = sorted(LOCATIONS.keys())
@@ -28,18 +32,27 @@ def get_state_keyboard(page: int = 0):
 
     return InlineKeyboardMarkup(buttons)
 
-def get_city_type_keyboard():
+def get_city_type_keyboard(allow_manual: bool = True):
     buttons = [
         [InlineKeyboardButton("🏙️ Large Cities", callback_data="city_type:large")],
         [InlineKeyboardButton("🏘️ Medium Cities", callback_data="city_type:medium")],
         [InlineKeyboardButton("🏡 Small Cities", callback_data="city_type:small")],
         [InlineKeyboardButton("🌆 All City Types", callback_data="city_type:all")],
-        [InlineKeyboardButton("🔍 Enter City Manually", callback_data="city_type:manual")]
     ]
+    # A typed city belongs to a single state
+    if allow_manual:
+        buttons.append([InlineKeyboardButton("🔍 Enter City Manually", callback_data="city_type:manual")])
     return InlineKeyboardMarkup(buttons)
 
+def describe(value) -> str:
+    """Keyword or state of a search for messages; batch jobs hold lists."""
+    return ", ".join(value) if isinstance(value, list) else str(value)
+
 async def search_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("🔍 Please enter a keyword for search:")
+    await update.message.reply_text(
+        "🔍 Please enter a keyword for search.\n"
+        "Several keywords separated by commas are collected in one run with one export."
+    )
     context.user_data["search_stage"] = "awaiting_keyword"
     context.user_data["search_data"] = {}
 
@@ -52,20 +65,37 @@ async def handle_text_response(update: Update, context: ContextTypes.DEFAULT_TYP
         email = update.message.text.strip()
         if is_valid_email(email):
             user_id = str(update.effective_user.id)
-            set_user_email(user_id, email, username)
+            # Creates the user's spreadsheet, keep it off the event loop
+            await asyncio.to_thread(set_user_email, user_id, email, username)
             context.user_data["awaiting_email"] = False
             await update.message.reply_text(f"✅ Email saved: {email}")
         else:
             await update.message.reply_text("❌ Invalid email. Try again:")
     
     elif stage == "awaiting_keyword":
-        keyword = update.message.text.strip()
-        if not keyword:
+        keywords = list(dict.fromkeys(k.strip() for k in update.message.text.split(",") if k.strip()))
+        if not keywords:
             await update.message.reply_text("❌ Please provide a valid keyword.")
             return
-        search_data["keyword"] = keyword
+        search_data["keyword"] = keywords[0] if len(keywords) == 1 else keywords
         context.user_data["search_stage"] = "awaiting_state"
-        await update.message.reply_text("🌎 Please select a US state:", reply_markup=get_state_keyboard(0))
+        await update.message.reply_text(
+            "🌎 Please select a US state, or type several state codes separated by commas (e.g. TX, OK):",
+            reply_markup=get_state_keyboard(0)
+        )
+
+    elif stage == "awaiting_state":
+        states = list(dict.fromkeys(code.strip().upper() for code in update.message.text.split(",") if code.strip()))
+        unknown = [code for code in states if code not in LOCATIONS]
+        if not states or unknown:
+            await update.message.reply_text(f"❌ Unknown state code: {', '.join(unknown) or '-'}. Try again:")
+            return
+        search_data["state"] = states[0] if len(states) == 1 else states
+        context.user_data["search_stage"] = "awaiting_city_type"
+        await update.message.reply_text(
+            "🏙️ Please select city type:",
+            reply_markup=get_city_type_keyboard(allow_manual=len(states) == 1)
+        )
     
     elif stage == "awaiting_city_name":
         city_name = update.message.text.strip()
@@ -79,6 +109,10 @@ async def handle_text_response(update: Update, context: ContextTypes.DEFAULT_TYP
     else:
         await update.message.reply_text("Unknown input. Use /search to begin.")
 
+def get_user(user_id: str) -> User | None:
+    with SessionLocal() as db:
+        return db.query(User).filter_by(user_id=user_id).first()
+
 def get_reply_target(update):
     if hasattr(update, "message") and update.message:
         return update.message
@@ -93,7 +127,7 @@ async def execute_search(update: Update, context: ContextTypes.DEFAULT_TYPE, sea
     city_name = search_data.get("city_name")
     
     user_id = str(update.effective_user.id)
-    email = get_user_email(user_id)
+    email = await asyncio.to_thread(get_user_email, user_id)
     
     reply_target = get_reply_target(update)
     if not keyword or not email:
@@ -101,33 +135,117 @@ async def execute_search(update: Update, context: ContextTypes.DEFAULT_TYPE, sea
             await reply_target.reply_text("❌ Session expired or email not set. Use /start to restart.")
         return
 
-    message = f"🔁 Started collection for keyword: `{keyword}`"
+    try:
+        # Queued on the job workers; the result arrives later through job_finished
+        await asyncio.to_thread(
+            run_collector_in_thread,
+            keyword,
+            state,
+            city_type,
+            city_name,
+            user_id,
+            chat_id=update.effective_chat.id,
+        )
+    except Exception as e:
+        if reply_target:
+            await reply_target.reply_text(f"❌ Error occurred: {str(e)}")
+        return
+
+    message = f"🔁 Queued collection for keyword: `{describe(keyword)}`"
     if state != "ALL":
-        message += f" in `{state}`"
+        message += f" in `{describe(state)}`"
     if city_type and city_type != "all":
         message += f" ({city_type} cities)"
     if city_name:
         message += f", city: {city_name}"
+    message += "\nYou will get a message when it is done."
 
     if reply_target:
         await reply_target.reply_text(message, parse_mode="Markdown")
 
+async def refresh_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/refresh <keyword> [STATE]: re-fetch details of stale companies."""
+    args = list(context.args or [])
+    state = None
+    if args and args[-1].upper() in LOCATIONS:
+        state = args.pop().upper()
+    keyword = " ".join(args).strip()
+    if not keyword:
+        await update.message.reply_text("Usage: /refresh <keyword> [STATE], e.g. /refresh logistics TX")
+        return
+
+    user_id = str(update.effective_user.id)
+    email = await asyncio.to_thread(get_user_email, user_id)
+    if not email:
+        await update.message.reply_text("❌ Email not set. Use /setemail first.")
+        return
     try:
-        with SessionLocal() as db:
-            task_id = run_collector_in_thread(keyword, state, city_type, city_name, user_id)
-            wait_for_task(task_id)
-            context.user_data["pending_sheet_params"] = {
-                "user_id": user_id,
-                "keyword": keyword,
-                "state": state,
-                "city_type": city_type,
-                "city_name": city_name,
-            }
-            
-            await ask_overwrite_sheet(update, context)
+        await asyncio.to_thread(run_refresh_in_thread, keyword, state, user_id, chat_id=update.effective_chat.id)
     except Exception as e:
-        if reply_target:
-            await reply_target.reply_text(f"❌ Error occurred: {str(e)}")
+        await update.message.reply_text(f"❌ Error occurred: {str(e)}")
+        return
+    where = f" in `{state}`" if state else ""
+    await update.message.reply_text(
+        f"🔁 Queued refresh of `{keyword}`{where} companies older than {REFRESH_MAX_AGE_DAYS} days.\n"
+        "You will get a message when it is done.",
+        parse_mode="Markdown",
+    )
+
+def get_latest_job_run(user_id: str) -> JobRun | None:
+    with SessionLocal() as db:
+        return (
+            db.query(JobRun)
+            .join(User, JobRun.user_email_id == User.id)
+            .filter(User.user_id == user_id)
+            .order_by(JobRun.id.desc())
+            .first()
+        )
+
+async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats: counters and latencies of the user's latest job."""
+    job_run = await asyncio.to_thread(get_latest_job_run, str(update.effective_user.id))
+    if not job_run:
+        await update.message.reply_text("No jobs yet. Use /search to start one.")
+        return
+    params = json.loads(job_run.params) if job_run.params else {}
+    task = get_task(job_run.task_id) if job_run.task_id else None
+    if job_run.metrics:
+        data = json.loads(job_run.metrics)
+    elif task:
+        data = task.stats.to_dict()
+    else:
+        data = None
+    text = f"📊 Job #{job_run.id} \"{params.get('keyword')}\": {job_run.status}\n"
+    text += metrics.summarize(data) if data else "No metrics recorded yet."
+    # Plain text, metric names are full of underscores
+    await update.message.reply_text(text)
+
+def get_job_run(job_run_id: int) -> JobRun | None:
+    with SessionLocal() as db:
+        return db.get(JobRun, job_run_id)
+
+def register_job_notifications(application: Application):
+    """Start the job workers and report every finished job to its chat."""
+    loop = asyncio.get_running_loop()
+
+    def on_job_finished(task: CollectorTask, user_id: str):
+        # Called from a job worker thread
+        loop.call_soon_threadsafe(application.create_task, job_finished(application, task, user_id))
+
+    job_queue.add_listener(on_job_finished)
+    # With COLLECTOR_BACKEND=async, jobs run as coroutines on this loop
+    job_queue.use_loop(loop)
+    job_queue.start()
+
+async def job_finished(application: Application, task: CollectorTask, user_id: str):
+    job_run = await asyncio.to_thread(get_job_run, task.job_run_id)
+    params = json.loads(job_run.params) if job_run and job_run.params else {}
+    chat_id = params.get("chat_id") or user_id
+    if task.status != "done":
+        await application.bot.send_message(chat_id, f"❌ Error occurred: {task.status}")
+        return
+    label = "Refresh" if params.get("type") == "refresh" else "Collection"
+    await ask_overwrite_sheet(application.bot, chat_id, task.job_run_id, params.get("keyword"), label)
 
 async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -158,54 +276,74 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
             await execute_search(update, context, search_data)
         return
 
-async def ask_overwrite_sheet(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    reply_target = get_reply_target(update)
+async def ask_overwrite_sheet(bot, chat_id, job_run_id: int, keyword: str | None, label: str = "Collection"):
+    # The run id travels in the callback data, so the buttons keep working after a restart
     keyboard = [
         [
-            InlineKeyboardButton("🔁 Overwrite", callback_data="sheet_overwrite:True"),
-            InlineKeyboardButton("➕ Append", callback_data="sheet_overwrite:False"),
-        ]
+            InlineKeyboardButton("🔁 Overwrite", callback_data=f"sheet_overwrite:True:{job_run_id}"),
+            InlineKeyboardButton("➕ Append", callback_data=f"sheet_overwrite:False:{job_run_id}"),
+        ],
+        [
+            InlineKeyboardButton("🔁 Overwrite (all matches)", callback_data=f"sheet_overwrite:True:{job_run_id}:all"),
+            InlineKeyboardButton("➕ Append (all matches)", callback_data=f"sheet_overwrite:False:{job_run_id}:all"),
+        ],
     ]
-    if reply_target:
-        await reply_target.reply_text(
-            "Do you want to overwrite the Google Sheet or append to it?",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+    await bot.send_message(
+        chat_id,
+        f"✅ {label} for `{keyword}` finished.\n"
+        "Do you want to overwrite the Google Sheet or append to it?\n"
+        "\"All matches\" also exports results collected by earlier searches.",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
 
 async def handle_sheet_overwrite(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     data = query.data
-    task_state = data.split(":")[1] == "True"
-    params = context.user_data.get("pending_sheet_params", {})
-    if not params:
+    parts = data.split(":")
+    task_state = parts[1] == "True"
+    all_matches = parts[-1] == "all"
+    reply_target = get_reply_target(update)
+    if len(parts) < 3 or not parts[2].isdigit():
+        if reply_target:
+            await reply_target.reply_text("❌ This export button has expired. Use /search to start again.")
         return
-    user_id = params.get("user_id")
-    keyword = params.get("keyword")
+    job_run_id = int(parts[2])
+    job_run = await asyncio.to_thread(get_job_run, job_run_id)
+    if not job_run:
+        if reply_target:
+            await reply_target.reply_text("❌ Search results not found.")
+        return
+    params = json.loads(job_run.params)
+    user_id = str(update.effective_user.id)
+    # Batch jobs export every keyword into the same sheet
+    keyword = params.get("keywords") or params.get("keyword")
     state = params.get("state")
     city_type = params.get("city_type")
     city_name = params.get("city_name")
-    reply_target = get_reply_target(update)
 
-    with SessionLocal() as db:
-            user = db.query(User).filter_by(user_id=user_id).first()
-            if not user:
-                if reply_target:
-                    await reply_target.reply_text("❌ User not found.")
-                return
-            try:
-                sheet_url = create_google_sheet(
-                    user.google_sheet_id,
-                    task_state,
-                    user.email,
-                    keyword,
-                    state,
-                    city_type,
-                    city_name
-                )
-                context.user_data["pending_sheet_params"] = None
-                if reply_target:
-                    await reply_target.reply_text(f"✅ Your Google Sheet:\n{sheet_url}")
-            except Exception as e:
-                if reply_target:
-                    await reply_target.reply_text(f"❌ Error occurred: {str(e)}")
+    user = await asyncio.to_thread(get_user, user_id)
+    if not user or user.id != job_run.user_email_id:
+        if reply_target:
+            await reply_target.reply_text("❌ User not found.")
+        return
+    try:
+        # The export talks to Google and streams from the DB, so it runs in a worker thread
+        sheet_url = await asyncio.to_thread(
+            create_google_sheet,
+            user.google_sheet_id,
+            task_state,
+            user.email,
+            keyword,
+            state,
+            city_type,
+            city_name,
+            job_run_id,
+            all_matches
+        )
+        if reply_target:
+            await reply_target.reply_text(f"✅ Your Google Sheet:\n{sheet_url}")
+    except Exception as e:
+        if reply_target:
+            await reply_target.reply_text(f"❌ Error occurred: {str(e)}")
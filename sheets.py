@@ -0,0 +1,115 @@
+import os
+import logging
+from typing import Callable, Iterable, Optional
+from dotenv import load_dotenv
+import metrics
+
+logger = logging.getLogger(__name__)
+# Configuration
+load_dotenv()
+# Rows sent per values.batchUpdate request
+SHEETS_CHUNK_ROWS = int(os.getenv("SHEETS_CHUNK_ROWS", "2000"))
+# Passed to googleapiclient's execute(), which backs off on 429/5xx and socket errors
+SHEETS_MAX_RETRIES = int(os.getenv("SHEETS_MAX_RETRIES", "5"))
+
+def execute(request):
+    with metrics.timed("sheets"):
+        return request.execute(num_retries=SHEETS_MAX_RETRIES)
+
+def a1(title: str, cell: str = "") -> str:
+    """A1 range on a tab, the whole tab when no cell is given."""
+    escaped = title.replace("'", "''")
+    return f"'{escaped}'!{cell}" if cell else f"'{escaped}'"
+
+def get_first_sheet(service, spreadsheet_id: str) -> dict:
+    """Properties (sheetId, title, gridProperties) of the spreadsheet's first tab."""
+    spreadsheet = execute(service.spreadsheets().get(
+        spreadsheetId=spreadsheet_id,
+        fields="sheets.properties(sheetId,title,gridProperties)",
+    ))
+    return spreadsheet["sheets"][0]["properties"]
+
+class ChunkedSheetWriter:
+    """Writes rows to one tab in bounded batches, growing the grid as needed.
+
+    With append=True every chunk goes through values.append after the last
+    filled row, so the existing contents never have to be read. on_flush is
+    called with each chunk once it has been written.
+    """
+    def __init__(
+        self,
+        service,
+        spreadsheet_id: str,
+        sheet: dict,
+        start_row: int = 1,
+        chunk_rows: int = SHEETS_CHUNK_ROWS,
+        append: bool = False,
+        on_flush: Optional[Callable[[list[list]], None]] = None,
+    ):
+        self.service = service
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_id = sheet["sheetId"]
+        self.title = sheet["title"]
+        grid = sheet.get("gridProperties", {})
+        self.row_count = grid.get("rowCount", 1000)
+        self.column_count = grid.get("columnCount", 26)
+        self.next_row = start_row
+        self.chunk_rows = chunk_rows
+        self.append = append
+        self.on_flush = on_flush
+        self.rows_written = 0
+
+    def _ensure_grid(self, last_row: int, columns: int):
+        requests = []
+        if last_row > self.row_count:
+            # Grow at least a chunk at a time to keep grid requests rare
+            extra = max(last_row - self.row_count, self.chunk_rows)
+            requests.append({"appendDimension": {"sheetId": self.sheet_id, "dimension": "ROWS", "length": extra}})
+            self.row_count += extra
+        if columns > self.column_count:
+            requests.append({"appendDimension": {"sheetId": self.sheet_id, "dimension": "COLUMNS", "length": columns - self.column_count}})
+            self.column_count = columns
+        if requests:
+            execute(self.service.spreadsheets().batchUpdate(
+                spreadsheetId=self.spreadsheet_id,
+                body={"requests": requests},
+            ))
+
+    def _flush(self, chunk: list[list]):
+        if self.append:
+            execute(self.service.spreadsheets().values().append(
+                spreadsheetId=self.spreadsheet_id,
+                range=a1(self.title),
+                valueInputOption="RAW",
+                insertDataOption="INSERT_ROWS",
+                body={"values": chunk},
+            ))
+        else:
+            self._write_at_next_row(chunk)
+        self.rows_written += len(chunk)
+        metrics.incr("sheet_rows", len(chunk))
+        if self.on_flush:
+            self.on_flush(chunk)
+
+    def _write_at_next_row(self, chunk: list[list]):
+        last_row = self.next_row + len(chunk) - 1
+        self._ensure_grid(last_row, max(len(row) for row in chunk))
+        execute(self.service.spreadsheets().values().batchUpdate(
+            spreadsheetId=self.spreadsheet_id,
+            body={
+                "valueInputOption": "RAW",
+                "data": [{"range": a1(self.title, f"A{self.next_row}"), "values": chunk}],
+            },
+        ))
+        self.next_row = last_row + 1
+
+    def write(self, rows: Iterable[list]) -> int:
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= self.chunk_rows:
+                self._flush(chunk)
+                chunk = []
+        if chunk:
+            self._flush(chunk)
+        return self.rows_written